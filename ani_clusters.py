@@ -0,0 +1,149 @@
+# single-linkage ANI clustering at several thresholds, plus cluster LCA / taxonomic purity
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+class MultiUnionFind:
+    """
+    Union-find over integer genome ids, one forest per ANI threshold, so a
+    single pass over the comparisons clusters at every threshold at once.
+
+    Edges are merged a chunk at a time: each edge's endpoints are mapped to
+    their current roots, the roots joined by the chunk's edges are grouped
+    with connected_components, and every root in a group is pointed at the
+    group's smallest root. Memory is one int64 parent array per threshold,
+    i.e. bounded by the number of genomes, not comparisons.
+    """
+    def __init__(self, thresholds, n=0):
+        self.thresholds = sorted(thresholds)
+        self.parents = [np.arange(n, dtype=np.int64) for _ in self.thresholds]
+
+    def __len__(self):
+        return len(self.parents[0]) if self.parents else 0
+
+    def grow(self, n):
+        "make room for ids < n (new ids start as singletons)"
+        old = len(self)
+        if n > old:
+            self.parents = [np.concatenate([parent, np.arange(old, n, dtype=np.int64)]) for parent in self.parents]
+
+    @staticmethod
+    def find(parent, ids):
+        roots = parent[ids]
+        while True:
+            up = parent[roots]
+            if np.array_equal(up, roots):
+                return roots
+            roots = up
+
+    @staticmethod
+    def compress(parent):
+        # pointer jumping: afterwards every id points straight at its root
+        while True:
+            up = parent[parent]
+            if np.array_equal(up, parent):
+                return
+            parent[:] = up
+
+    def add_edges(self, ids1, ids2, anis):
+        ids1 = np.asarray(ids1, dtype=np.int64)
+        ids2 = np.asarray(ids2, dtype=np.int64)
+        anis = np.asarray(anis, dtype=np.float64)
+        self.grow(int(max(ids1.max(initial=-1), ids2.max(initial=-1))) + 1)
+        for threshold, parent in zip(self.thresholds, self.parents):
+            keep = anis >= threshold
+            if not keep.any():
+                # thresholds are sorted, so no higher one has edges either
+                break
+            roots1 = self.find(parent, ids1[keep])
+            roots2 = self.find(parent, ids2[keep])
+            joined = roots1 != roots2
+            if not joined.any():
+                continue
+            roots, local = np.unique(np.concatenate([roots1[joined], roots2[joined]]), return_inverse=True)
+            n_edges = int(joined.sum())
+            graph = sparse.coo_matrix((np.ones(n_edges, dtype=np.int8), (local[:n_edges], local[n_edges:])),
+                                      shape=(len(roots), len(roots)))
+            _, group = connected_components(graph, directed=False)
+            # smallest root of each group; roots are sorted, so that's the first one seen
+            _, first = np.unique(group, return_index=True)
+            parent[roots] = roots[first][group]
+            self.compress(parent)
+
+    def labels(self, n=None):
+        "per threshold, an array of cluster labels 0..k-1 over ids 0..n-1, numbered by smallest member"
+        if n is not None:
+            self.grow(n)
+        labels = []
+        for parent in self.parents:
+            self.compress(parent)
+            _, label = np.unique(parent, return_inverse=True)
+            labels.append(label)
+        return labels
+
+
+def cluster_taxonomy(tax_index, tax_rows, label, purity_depth):
+    """
+    LCA and taxonomic purity of each cluster, vectorised over clusters.
+
+    tax_rows: lineage row (TaxonomyIndex) per genome, -1 if not in taxonomy;
+    label: cluster per genome. Genomes without a lineage are left out of the
+    LCA and purity. Returns a dict of per-cluster arrays:
+      size, n_taxonomy      members, and members with a lineage
+      lca_depth, lca_row    ranks shared by all members with a lineage; a
+                            member row to read the LCA lineage from
+      purity, majority_row  fraction of members with a lineage in the most
+                            common taxon at purity_depth, and a row of that taxon
+      lca_genomes           genomes (of all genomes given) under the LCA taxon
+    """
+    n_clusters = label.max() + 1 if len(label) else 0
+    size = np.bincount(label, minlength=n_clusters)
+    has_tax = tax_rows >= 0
+    n_taxonomy = np.bincount(label[has_tax], minlength=n_clusters)
+
+    order = np.flatnonzero(has_tax)
+    order = order[np.argsort(label[order], kind="stable")]
+    sorted_label = label[order]
+    sorted_rows = tax_rows[order]
+    taxon_ids = tax_index.taxon_ids[sorted_rows] if len(order) else np.zeros((0, tax_index.taxon_ids.shape[1]), dtype=np.int64)
+    clusters, starts = np.unique(sorted_label, return_index=True)
+
+    lca_depth = np.zeros(n_clusters, dtype=np.int64)
+    lca_row = np.full(n_clusters, -1, dtype=np.int64)
+    purity = np.full(n_clusters, np.nan)
+    majority_row = np.full(n_clusters, -1, dtype=np.int64)
+    lca_genomes = np.zeros(n_clusters, dtype=np.int64)
+    if not len(clusters):
+        return dict(size=size, n_taxonomy=n_taxonomy, lca_depth=lca_depth, lca_row=lca_row,
+                    purity=purity, majority_row=majority_row, lca_genomes=lca_genomes)
+
+    # a rank is shared by all members iff its taxon id has min == max (and is set)
+    lo = np.minimum.reduceat(taxon_ids, starts, axis=0)
+    hi = np.maximum.reduceat(taxon_ids, starts, axis=0)
+    shared = (lo == hi) & (lo >= 0)
+    lca_depth[clusters] = np.cumprod(shared, axis=1).sum(axis=1)
+    lca_row[clusters] = sorted_rows[starts]
+
+    # genomes under each taxon, for how much of the LCA taxon the cluster covers
+    all_ids = tax_index.taxon_ids[tax_rows[has_tax]]
+    depth = lca_depth[clusters]
+    lca_taxon = np.where(depth > 0, taxon_ids[starts, np.maximum(depth - 1, 0)], -1)
+    for d in np.unique(depth[depth > 0]):
+        taxa, counts = np.unique(all_ids[:, d - 1], return_counts=True)
+        at_d = depth == d
+        lca_genomes[clusters[at_d]] = counts[np.searchsorted(taxa, lca_taxon[at_d])]
+
+    # majority taxon at purity_depth: count (cluster, taxon) pairs, keep the largest per cluster
+    if purity_depth <= taxon_ids.shape[1]:
+        taxon = taxon_ids[:, purity_depth - 1]
+        pairs, first, counts = np.unique(np.stack([sorted_label, taxon], axis=1), axis=0,
+                                         return_index=True, return_counts=True)
+        # unassigned (-1) taxa never count as the majority
+        counts = np.where(pairs[:, 1] >= 0, counts, 0)
+        best = np.lexsort((-counts, pairs[:, 0]))
+        best = best[np.r_[True, pairs[best[1:], 0] != pairs[best[:-1], 0]]]
+        purity[pairs[best, 0]] = counts[best] / n_taxonomy[pairs[best, 0]]
+        majority_row[pairs[best, 0]] = np.where(counts[best] > 0, sorted_rows[first[best]], -1)
+    return dict(size=size, n_taxonomy=n_taxonomy, lca_depth=lca_depth, lca_row=lca_row,
+                purity=purity, majority_row=majority_row, lca_genomes=lca_genomes)
@@ -0,0 +1,236 @@
+# read/write LCA-ANI tables as csv or parquet (chosen by file extension)
+import io
+import csv
+import gzip
+import itertools
+from collections import defaultdict
+
+# parquet column types: ANI/containment values as float32, rank/lineage dictionary-encoded
+FLOAT_COLUMNS = {"ani", "query_ani", "match_ani", "avg_ani",
+                 "query_containment", "match_containment", "avg_containment",
+                 "ref_ani", "fmh_ani", "fmh_aai", "fmh_d_ns"}
+DICTIONARY_COLUMNS = {"lca_rank", "lca_lineage"}
+# parquet row groups each hold a single lca_rank, so readers can skip ranks via row group stats
+PARTITION_COLUMN = "lca_rank"
+
+
+# csvs ending in .gz / .zst are (de)compressed as a stream; zstd needs the zstandard package.
+# large buffers keep reads + writes to network filesystems to a few big requests
+BUFFER_SIZE = 4 << 20
+
+
+def is_parquet(path):
+    return str(path).endswith(".parquet")
+
+
+def compression(path):
+    "'gzip', 'zstd' or None, from the file extension"
+    path = str(path)
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith((".zst", ".zstd")):
+        return "zstd"
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("reading or writing .zst files needs the 'zstandard' package")
+    return zstandard
+
+
+class HashingReader(io.RawIOBase):
+    "raw reader over the binary file `fp` that feeds every byte read to `digest` (e.g. hashlib.md5())"
+    def __init__(self, fp, digest):
+        self.fp = fp
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.fp.readinto(b)
+        if n:
+            self.digest.update(memoryview(b)[:n])
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.fp.close()
+        super().close()
+
+
+class _GzipFile(gzip.GzipFile):
+    "GzipFile that also closes the file object it was given"
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def open_table(path, mode='r', buffer_size=BUFFER_SIZE, level=None, digest=None):
+    """
+    Open a csv for reading ('r') or writing ('w') as text, streaming it
+    through gzip or zstd if `path` ends in .gz or .zst. The file is read and
+    written `buffer_size` bytes at a time. `level` is the compression level
+    (default: 6 for gzip, 3 for zstd, which compresses on all cores).
+    When reading, the file's raw (still compressed) bytes are fed to
+    `digest`, if given, as they are read.
+    """
+    kind = compression(path)
+    if kind is None and digest is None:
+        return open(path, mode, buffering=buffer_size, newline='')
+    if mode not in ('r', 'w') or (digest is not None and mode != 'r'):
+        raise ValueError(f"can't open '{path}' with mode '{mode}'")
+    if digest is not None:
+        fp = io.BufferedReader(HashingReader(open(path, 'rb', buffering=0), digest), buffer_size)
+    else:
+        fp = open(path, mode + 'b', buffering=buffer_size)
+    if kind == "gzip":
+        stream = _GzipFile(fileobj=fp, mode=mode + 'b', compresslevel=6 if level is None else level)
+    elif kind == "zstd":
+        zstd = _zstandard()
+        if mode == 'r':
+            stream = zstd.ZstdDecompressor().stream_reader(fp, read_size=buffer_size, read_across_frames=True)
+        else:
+            stream = zstd.ZstdCompressor(level=3 if level is None else level, threads=-1).stream_writer(fp)
+    else:
+        # uncompressed, read through the digest
+        return io.TextIOWrapper(fp, encoding='utf-8', newline='')
+    if mode == 'r':
+        stream = io.BufferedReader(stream, buffer_size)
+    else:
+        stream = io.BufferedWriter(stream, buffer_size)
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def to_float(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def parquet_schema(fields):
+    import pyarrow as pa
+    columns = []
+    for field in fields:
+        if field in FLOAT_COLUMNS:
+            columns.append(pa.field(field, pa.float32()))
+        elif field in DICTIONARY_COLUMNS:
+            columns.append(pa.field(field, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            columns.append(pa.field(field, pa.string()))
+    return pa.schema(columns)
+
+
+class TableWriter:
+    """
+    csv.writer-like writer for LCA-ANI tables. Writes parquet if `path`
+    ends in .parquet, csv otherwise (compressed if it ends in .gz / .zst). Parquet rows are buffered per lca_rank
+    and written as row groups of up to `row_group_size` rows.
+    """
+    def __init__(self, path, fields, row_group_size=250000):
+        self.path = path
+        self.fields = list(fields)
+        self.row_group_size = row_group_size
+        self.parquet = is_parquet(path)
+        if self.parquet:
+            import pyarrow.parquet as pq
+            self.schema = parquet_schema(self.fields)
+            self.pq_writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+            self.partition_idx = self.fields.index(PARTITION_COLUMN) if PARTITION_COLUMN in self.fields else None
+            self.groups = defaultdict(list)
+        else:
+            self.fp = open_table(path, 'w')
+            self.csv_writer = csv.writer(self.fp)
+            self.csv_writer.writerow(self.fields)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writerow(self, row):
+        if not self.parquet:
+            self.csv_writer.writerow(row)
+            return
+        key = row[self.partition_idx] if self.partition_idx is not None else None
+        group = self.groups[key]
+        group.append(row)
+        if len(group) >= self.row_group_size:
+            self._write_group(key)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _write_group(self, key):
+        import pyarrow as pa
+        rows = self.groups.pop(key)
+        arrays = []
+        for field, values in zip(self.schema, zip(*rows)):
+            if field.name in FLOAT_COLUMNS:
+                arrays.append(pa.array([to_float(v) for v in values], type=pa.float32()))
+            elif field.name in DICTIONARY_COLUMNS:
+                arrays.append(pa.array([None if v is None else str(v) for v in values]).dictionary_encode())
+            else:
+                arrays.append(pa.array([None if v is None else str(v) for v in values], type=pa.string()))
+        self.pq_writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=len(rows))
+
+    def close(self):
+        if self.parquet:
+            for key in sorted(self.groups, key=lambda k: (k is None, k or "")):
+                self._write_group(key)
+            self.pq_writer.close()
+        else:
+            self.fp.close()
+
+
+def read_table_chunks(path, columns, chunk_size=1000000, dtype=None):
+    "yield pandas DataFrames of up to chunk_size rows of `columns` from a csv (optionally compressed) or parquet table"
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(columns=columns, batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size, dtype=dtype)
+
+
+def read_csv_columns(path, columns, chunk_size=1000000, digest=None):
+    """
+    Yield `columns` of a csv (optionally compressed), chunk_size rows at a
+    time, as a tuple of one list of strings per column. Other columns are
+    never kept. The file's bytes as stored are fed to `digest`, if given.
+    """
+    with open_table(path, digest=digest) as fp:
+        reader = csv.reader(fp)
+        header = next(reader, None)
+        if header is None:
+            return
+        missing = [c for c in columns if c not in header]
+        if missing:
+            raise ValueError(f"'{path}' has no column(s) {', '.join(missing)}")
+        indices = [header.index(c) for c in columns]
+        while True:
+            chunk = [[row[n] for n in indices] for row in itertools.islice(reader, chunk_size)]
+            if not chunk:
+                return
+            yield tuple(map(list, zip(*chunk)))
+
+
+def read_table_rows(path, columns=None):
+    "yield each row of a csv (optionally compressed) or parquet LCA-ANI table as a dict"
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(columns=columns):
+            yield from batch.to_pylist()
+    else:
+        with open_table(path) as fp:
+            yield from csv.DictReader(fp)
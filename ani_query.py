@@ -0,0 +1,309 @@
+# read-only queries over an LCA-ANI database (see anidb.py), for anidb-query.py and notebooks
+import os
+import queue
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sourmash.tax import tax_utils
+from sourmash.logging import notify
+
+from anidb import STAT_COLUMNS, NEIGHBOR_DTYPE, readonly_uri
+from taxonomy_index import swap_gcf_gca
+
+# n, min, avg, max, std, quantiles -- the summary table columns without the running sums
+REPORT_COLUMNS = STAT_COLUMNS[:-2]
+# IN (...) lists are padded to one of these sizes, so each size is prepared once per connection
+IN_LIST_SIZES = (1, 16, 256)
+
+LINEAGE_STATS = "SELECT lineage_id, {columns} FROM lineage_summary WHERE lineage_id IN ({params})"
+RANK_STATS = f"SELECT rank_id, {', '.join(REPORT_COLUMNS)} FROM rank_summary"
+GENOME = "SELECT genome_id, ident, name FROM genomes WHERE ident = ?"
+GENOMES_BY_ID = "SELECT genome_id, ident, name FROM genomes WHERE genome_id IN ({params})"
+NEIGHBORS = "SELECT n_neighbors, neighbors FROM genome_neighbors WHERE genome_id = ?"
+# one indexed lookup per side of the pair
+GENOME_COMPARISONS = '''
+SELECT g.ident, g.name, c.lineage_id, c.ani
+FROM (SELECT genome_id2 AS other, lineage_id, ani FROM ani_comparisons WHERE genome_id1 = :genome_id
+      UNION ALL
+      SELECT genome_id1 AS other, lineage_id, ani FROM ani_comparisons WHERE genome_id2 = :genome_id) c
+JOIN genomes g ON g.genome_id = c.other
+WHERE c.ani >= :min_ani
+ORDER BY c.ani DESC
+LIMIT :limit
+'''
+
+
+def in_list_chunks(values):
+    "split values into chunks padded (with None) to one of IN_LIST_SIZES"
+    values = list(values)
+    max_size = IN_LIST_SIZES[-1]
+    for start in range(0, len(values), max_size):
+        chunk = values[start:start + max_size]
+        size = next(size for size in IN_LIST_SIZES if size >= len(chunk))
+        yield chunk + [None] * (size - len(chunk))
+
+
+class ConnectionPool:
+    """
+    Read-only SQLite connections shared between threads; borrow one with
+    `with pool.connection() as db`. Up to `size` connections are opened on
+    demand, with memory-mapped reads. sqlite3 keeps a prepared statement
+    cache per connection, so a fixed set of query strings is only compiled
+    once per connection.
+    """
+    def __init__(self, path, size=4, mmap_mb=1024, cache_mb=64):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.uri = readonly_uri(path)
+        self.size = size
+        self.mmap_mb = mmap_mb
+        self.cache_mb = cache_mb
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.n_open = 0
+
+    def _open(self):
+        db = sqlite3.connect(self.uri, uri=True, check_same_thread=False, cached_statements=256)
+        db.execute(f"PRAGMA mmap_size={int(self.mmap_mb) * 2**20}")
+        # negative cache_size is in KiB
+        db.execute(f"PRAGMA cache_size={-int(self.cache_mb) * 1024}")
+        db.execute("PRAGMA query_only=ON")
+        return db
+
+    @contextmanager
+    def connection(self):
+        try:
+            db = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.n_open < self.size
+                if can_open:
+                    self.n_open += 1
+            if can_open:
+                try:
+                    db = self._open()
+                except Exception:
+                    with self.lock:
+                        self.n_open -= 1
+                    raise
+            else:
+                db = self.idle.get()
+        try:
+            yield db
+        finally:
+            self.idle.put(db)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class LruCache:
+    "Thread-safe least-recently-used map with hit/miss counts; caches negative (None) results too."
+    MISSING = object()
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        "cached value, or LruCache.MISSING"
+        with self.lock:
+            value = self.items.get(key, self.MISSING)
+            if value is self.MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def info(self):
+        with self.lock:
+            return {"size": len(self.items), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class AniQuery:
+    """
+    Lineage, rank and genome queries over an LCA-ANI database, safe to share
+    between threads.
+
+    Ranks and lineage names are read into memory once (they are small);
+    per-lineage stats come from the precomputed summary tables, nearest
+    neighbors from the per-genome top-k table and other comparisons for a
+    genome from the genome id indexes. Results are kept in
+    an LRU cache keyed by query, so repeated lookups of hot lineages and
+    genomes don't touch the database.
+    """
+    def __init__(self, path, pool_size=4, cache_size=100000, mmap_mb=1024, cache_mb=64):
+        self.path = path
+        self.pool = ConnectionPool(path, size=pool_size, mmap_mb=mmap_mb, cache_mb=cache_mb)
+        self.cache = LruCache(cache_size)
+        with self.pool.connection() as db:
+            self.ranks = dict(db.execute("SELECT rank_id, rank FROM ranks"))
+            self.lineages = {}
+            self.lineage_ids = {}
+            for lineage_id, rank_id, name in db.execute("SELECT lineage_id, rank_id, name FROM lineages"):
+                self.lineages[lineage_id] = (self.ranks[rank_id], name)
+                self.lineage_ids.setdefault(name, []).append(lineage_id)
+            indexes = set(name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+            has_summaries = db.execute("SELECT 1 FROM rank_summary LIMIT 1").fetchone() is not None
+            tables = set(name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+            self.has_neighbors = "genome_neighbors" in tables and \
+                db.execute("SELECT 1 FROM genome_neighbors LIMIT 1").fetchone() is not None
+        if not has_summaries:
+            notify(f"WARNING: '{path}' has no summary tables (a shard built with --no-summaries?); stats will be empty")
+        if not {"ani_comparisons_genome1", "ani_comparisons_genome2"} <= indexes:
+            notify(f"WARNING: '{path}' has no genome indexes; genome queries will scan all comparisons")
+        if not self.has_neighbors:
+            notify(f"WARNING: '{path}' has no nearest-neighbor table; neighbor queries will use the genome indexes")
+
+    def close(self):
+        self.pool.close()
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def rank_stats(self):
+        "{rank: stats} for every rank with comparisons"
+        found = self.cache.get(("ranks",))
+        if found is LruCache.MISSING:
+            with self.pool.connection() as db:
+                found = dict((self.ranks[rank_id], dict(zip(REPORT_COLUMNS, stats)))
+                             for rank_id, *stats in db.execute(RANK_STATS))
+            self.cache.put(("ranks",), found)
+        return found
+
+    def lineage_stats(self, name):
+        "stats for the LCA lineage `name`, one dict per rank it occurs at (usually one); [] if not found"
+        return self.lineage_stats_batch([name])[name]
+
+    def lineage_stats_batch(self, names):
+        "{name: lineage_stats(name)}, looking up all uncached names in a few queries"
+        results = {}
+        misses = []
+        todo = {}
+        for name in names:
+            if name in results:
+                continue
+            found = self.cache.get(("lineage", name))
+            if found is LruCache.MISSING:
+                misses.append(name)
+                for lineage_id in self.lineage_ids.get(name, []):
+                    todo[lineage_id] = name
+                results[name] = []
+            else:
+                results[name] = found
+        if todo:
+            columns = ", ".join(REPORT_COLUMNS)
+            with self.pool.connection() as db:
+                for chunk in in_list_chunks(todo):
+                    sql = LINEAGE_STATS.format(columns=columns, params=", ".join("?" * len(chunk)))
+                    for lineage_id, *stats in db.execute(sql, chunk):
+                        rank, name = self.lineages[lineage_id]
+                        results[name].append(dict(rank=rank, lca_name=name, **dict(zip(REPORT_COLUMNS, stats))))
+        for name in misses:
+            self.cache.put(("lineage", name), results[name])
+        return results
+
+    def find_genome(self, db, ident):
+        "(genome_id, ident, name) for an identifier or genome name (any version, GCA/GCF), or None"
+        ident = tax_utils.get_ident(ident)
+        found = db.execute(GENOME, (ident,)).fetchone()
+        if found is None:
+            found = db.execute(GENOME, (swap_gcf_gca(ident),)).fetchone()
+        return found
+
+    def genome_comparisons(self, ident, min_ani=None, limit=None):
+        """
+        comparisons involving one genome, highest ANI first: dicts of the other
+        genome's ident + name, the LCA rank + name and ANI. None if the genome isn't in the db.
+        """
+        key = ("genome", ident, min_ani, limit)
+        found = self.cache.get(key)
+        if found is not LruCache.MISSING:
+            return found
+        with self.pool.connection() as db:
+            genome = self.find_genome(db, ident)
+            if genome is None:
+                found = None
+            else:
+                params = {"genome_id": genome[0], "min_ani": -1.0 if min_ani is None else min_ani,
+                          "limit": -1 if limit is None else limit}
+                found = []
+                for other, name, lineage_id, ani in db.execute(GENOME_COMPARISONS, params):
+                    lca_rank, lca_name = self.lineages[lineage_id]
+                    found.append({"ident": other, "name": name, "lca_rank": lca_rank, "lca_name": lca_name, "ani": ani})
+        self.cache.put(key, found)
+        return found
+
+    def genome_comparisons_batch(self, idents, min_ani=None, limit=None):
+        return dict((ident, self.genome_comparisons(ident, min_ani=min_ani, limit=limit)) for ident in idents)
+
+    def neighbor_ids(self, db, genome_id, k):
+        """
+        NEIGHBOR_DTYPE array of the k nearest neighbors of a genome id, highest
+        ANI first, or None if the stored top-k is too short to answer.
+        """
+        found = db.execute(NEIGHBORS, (genome_id,)).fetchone()
+        if found is None:
+            # no comparisons at all
+            return np.empty(0, dtype=NEIGHBOR_DTYPE)
+        n_neighbors, blob = found
+        neighbors = np.frombuffer(blob, dtype=NEIGHBOR_DTYPE)
+        if len(neighbors) < min(k, n_neighbors):
+            return None
+        return neighbors[:k]
+
+    def nearest_neighbors(self, ident, k=10):
+        """
+        the k genomes with the highest ANI to one genome, as dicts like
+        genome_comparisons (ANI is stored as float32). None if the genome isn't in the db.
+        """
+        key = ("neighbors", ident, k)
+        found = self.cache.get(key)
+        if found is not LruCache.MISSING:
+            return found
+        neighbors = None
+        with self.pool.connection() as db:
+            genome = self.find_genome(db, ident)
+            if genome is not None and self.has_neighbors:
+                neighbors = self.neighbor_ids(db, genome[0], k)
+            if neighbors is not None:
+                genomes = {}
+                for chunk in in_list_chunks(neighbors["genome_id"].tolist()):
+                    sql = GENOMES_BY_ID.format(params=", ".join("?" * len(chunk)))
+                    for genome_id, other, name in db.execute(sql, chunk):
+                        genomes[genome_id] = (other, name)
+                found = []
+                for genome_id, lineage_id, ani in neighbors.tolist():
+                    other, name = genomes[genome_id]
+                    lca_rank, lca_name = self.lineages[lineage_id]
+                    found.append({"ident": other, "name": name, "lca_rank": lca_rank, "lca_name": lca_name, "ani": ani})
+        if genome is None:
+            found = None
+        elif neighbors is None:
+            # more than the stored top-k, or no neighbor table: use the genome indexes
+            found = self.genome_comparisons(ident, limit=k)
+        self.cache.put(key, found)
+        return found
+
+    def nearest_neighbors_batch(self, idents, k=10):
+        return dict((ident, self.nearest_neighbors(ident, k=k)) for ident in idents)
@@ -0,0 +1,243 @@
+# streaming summary statistics for ANI values
+import csv
+import numpy as np
+from sourmash.logging import notify
+
+from ani_io import open_table
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+QUANTILE_NAMES = ("q05", "q25", "median", "q75", "q95")
+
+
+class AniStats:
+    """
+    Running count/min/max/sum/sum-of-squares plus a fixed-bin histogram over
+    [lo, hi], so stats can be built in one pass and merged across groups.
+    Quantiles are interpolated within a bin (error <= bin width) and clamped
+    to the observed min/max.
+    """
+    def __init__(self, n_bins=1000, lo=0.0, hi=1.0):
+        self.n_bins = n_bins
+        self.lo = lo
+        self.hi = hi
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.hist = np.zeros(n_bins, dtype=np.int64)
+
+    def bin_index(self, values):
+        idx = ((values - self.lo) / (self.hi - self.lo) * self.n_bins).astype(np.int64)
+        return np.clip(idx, 0, self.n_bins - 1)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sum += values.sum()
+        self.sum_sq += (values * values).sum()
+        self.hist += np.bincount(self.bin_index(values), minlength=self.n_bins)
+
+    def merge(self, other):
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.hist += other.hist
+
+    @property
+    def mean(self):
+        return self.sum / self.n if self.n else None
+
+    @property
+    def std(self):
+        if not self.n:
+            return None
+        mean = self.sum / self.n
+        return float(np.sqrt(max(self.sum_sq / self.n - mean * mean, 0.0)))
+
+    def quantile(self, q):
+        if not self.n:
+            return None
+        cum = np.cumsum(self.hist)
+        target = q * self.n
+        b = int(np.searchsorted(cum, target))
+        b = min(b, self.n_bins - 1)
+        below = cum[b - 1] if b else 0
+        in_bin = self.hist[b]
+        frac = (target - below) / in_bin if in_bin else 0.0
+        width = (self.hi - self.lo) / self.n_bins
+        value = self.lo + (b + frac) * width
+        return float(min(max(value, self.min), self.max))
+
+    def summary(self):
+        "n, min, avg, max, std, then QUANTILES"
+        if not self.n:
+            return [0, None, None, None, None] + [None] * len(QUANTILES)
+        return [self.n, float(self.min), self.mean, float(self.max), self.std] + \
+               [self.quantile(q) for q in QUANTILES]
+
+
+def stats_by_sorted_group(cursor, chunk_size=1000000, **kwargs):
+    """
+    Consume (*group_key, ani) rows ordered by group key, yielding
+    (group_key, AniStats) as each group completes. Memory is one histogram,
+    regardless of how many rows or groups there are.
+    """
+    group_key, stats = None, None
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        keys = [row[:-1] for row in chunk]
+        anis = np.array([row[-1] for row in chunk], dtype=np.float64)
+        starts = [0] + [n for n in range(1, len(keys)) if keys[n] != keys[n - 1]]
+        ends = starts[1:] + [len(keys)]
+        for start, end in zip(starts, ends):
+            if keys[start] != group_key:
+                if stats is not None:
+                    yield group_key, stats
+                group_key, stats = keys[start], AniStats(**kwargs)
+            stats.add(anis[start:end])
+    if stats is not None:
+        yield group_key, stats
+
+
+class ErrorStats:
+    """
+    Streaming accuracy of estimated vs reference ANI: bias (mean error),
+    MAE, RMSE, Pearson correlation and error quantiles, in one pass and
+    mergeable across groups. Means and co-moments are combined chunk by
+    chunk (Chan et al.), so the correlation stays accurate when ANI values
+    are all close to 1. Error = estimate - reference; its distribution is an
+    AniStats histogram over [-error_range, error_range].
+    """
+    def __init__(self, n_bins=2000, error_range=0.2):
+        self.n = 0
+        self.mean_ref = 0.0
+        self.mean_est = 0.0
+        self.m2_ref = 0.0
+        self.m2_est = 0.0
+        self.c_ref_est = 0.0
+        self.sum_abs_err = 0.0
+        self.errors = AniStats(n_bins=n_bins, lo=-error_range, hi=error_range)
+
+    def _combine(self, n, mean_ref, mean_est, m2_ref, m2_est, c_ref_est):
+        total = self.n + n
+        d_ref = mean_ref - self.mean_ref
+        d_est = mean_est - self.mean_est
+        w = self.n * n / total
+        self.m2_ref += m2_ref + d_ref * d_ref * w
+        self.m2_est += m2_est + d_est * d_est * w
+        self.c_ref_est += c_ref_est + d_ref * d_est * w
+        self.mean_ref += d_ref * n / total
+        self.mean_est += d_est * n / total
+        self.n = total
+
+    def add(self, ref, est):
+        ref = np.asarray(ref, dtype=np.float64)
+        est = np.asarray(est, dtype=np.float64)
+        if not len(ref):
+            return
+        mean_ref, mean_est = ref.mean(), est.mean()
+        d_ref, d_est = ref - mean_ref, est - mean_est
+        self._combine(len(ref), mean_ref, mean_est, (d_ref * d_ref).sum(), (d_est * d_est).sum(), (d_ref * d_est).sum())
+        err = est - ref
+        self.sum_abs_err += np.abs(err).sum()
+        self.errors.add(err)
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.mean_ref, other.mean_est, other.m2_ref, other.m2_est, other.c_ref_est)
+        self.sum_abs_err += other.sum_abs_err
+        self.errors.merge(other.errors)
+
+    def summary(self):
+        "n, mean ref, mean estimate, bias, MAE, RMSE, error std, Pearson r, then error min, QUANTILES, max"
+        if not self.n:
+            return [0] + [None] * (9 + len(QUANTILES))
+        bias = self.mean_est - self.mean_ref
+        # var(err) = var(est) + var(ref) - 2 cov(ref, est)
+        var_err = max((self.m2_est + self.m2_ref - 2 * self.c_ref_est) / self.n, 0.0)
+        denom = np.sqrt(self.m2_ref * self.m2_est)
+        r = float(self.c_ref_est / denom) if denom > 0 else None
+        return [self.n, float(self.mean_ref), float(self.mean_est), float(bias), float(self.sum_abs_err / self.n),
+                float(np.sqrt(bias * bias + var_err)), float(np.sqrt(var_err)), r,
+                float(self.errors.min)] + [self.errors.quantile(q) for q in QUANTILES] + [float(self.errors.max)]
+
+
+ERROR_COLUMNS = ["n", "mean_ref_ani", "mean_est_ani", "bias", "mae", "rmse", "std_err", "pearson_r", "min_err"] + \
+                [f"{q}_err" for q in QUANTILE_NAMES] + ["max_err"]
+
+
+class AccuracyReport:
+    """
+    ErrorStats per (LCA rank, reference ANI bin), fed a chunk of rows at a
+    time. Memory depends on the number of ranks and bins, not rows. rows()
+    reports every rank x bin group plus per-rank, per-bin and overall totals
+    ("all"), merged from the groups.
+    """
+    def __init__(self, bin_width=0.01, **kwargs):
+        self.bin_width = bin_width
+        self.kwargs = kwargs
+        self.groups = {}
+
+    def add(self, ranks, ref, est):
+        ranks = np.asarray(ranks, dtype=object)
+        ref = np.asarray(ref, dtype=np.float64)
+        est = np.asarray(est, dtype=np.float64)
+        keep = ~(np.isnan(ref) | np.isnan(est))
+        ranks, ref, est = ranks[keep], ref[keep], est[keep]
+        if not len(ref):
+            return
+        bins = np.floor(ref / self.bin_width + 1e-9).astype(np.int64)
+        rank_names, rank_idx = np.unique(ranks.astype(str), return_inverse=True)
+        keys, group = np.unique(np.stack([rank_idx, bins], axis=1), axis=0, return_inverse=True)
+        group = group.reshape(-1)
+        order = np.argsort(group, kind="stable")
+        starts = np.r_[0, np.flatnonzero(np.diff(group[order])) + 1]
+        ends = np.r_[starts[1:], len(order)]
+        for (r, b), start, end in zip(keys, starts, ends):
+            key = (str(rank_names[r]), int(b))
+            stats = self.groups.get(key)
+            if stats is None:
+                stats = self.groups[key] = ErrorStats(**self.kwargs)
+            rows = order[start:end]
+            stats.add(ref[rows], est[rows])
+
+    def rows(self, rank_order=()):
+        "(lca_rank, ani_bin, *ErrorStats.summary()); ani_bin is the bin's lower edge"
+        order = dict((rank, n) for n, rank in enumerate(rank_order))
+        rank_key = lambda rank: (order.get(rank, len(order)), rank)
+        by_rank, by_bin, total = {}, {}, ErrorStats(**self.kwargs)
+        for (rank, b), stats in self.groups.items():
+            by_rank.setdefault(rank, ErrorStats(**self.kwargs)).merge(stats)
+            by_bin.setdefault(b, ErrorStats(**self.kwargs)).merge(stats)
+            total.merge(stats)
+        edge = lambda b: round(b * self.bin_width, 6)
+        for rank, b in sorted(self.groups, key=lambda key: (rank_key(key[0]), key[1])):
+            yield [rank, edge(b)] + self.groups[(rank, b)].summary()
+        for rank in sorted(by_rank, key=rank_key):
+            yield [rank, "all"] + by_rank[rank].summary()
+        for b in sorted(by_bin):
+            yield ["all", edge(b)] + by_bin[b].summary()
+        yield ["all", "all"] + total.summary()
+
+    def write(self, path, rank_order=()):
+        "write rows() as a csv (compressed if path ends in .gz / .zst)"
+        with open_table(path, 'w') as fp:
+            w = csv.writer(fp)
+            w.writerow(["lca_rank", "ref_ani_bin"] + ERROR_COLUMNS)
+            for row in self.rows(rank_order):
+                w.writerow(["" if x is None else x for x in row])
+
+    def notify_summary(self, rank_order=()):
+        for rank, ani_bin, n, _, _, bias, mae, rmse, _, r, *_ in self.rows(rank_order):
+            if ani_bin == "all":
+                r = "n/a" if r is None else f"{r:.4f}"
+                notify(f"{rank}: n={n} bias={bias:+.5f} MAE={mae:.5f} RMSE={rmse:.5f} r={r}")
@@ -0,0 +1,235 @@
+# shared helpers for the prefetch/linref --> LCA-ANI scripts
+import csv
+import heapq
+import itertools
+import multiprocessing
+import tempfile
+from collections import deque
+
+import numpy as np
+from sourmash.distance_utils import containment_to_distance
+from sourmash.logging import notify
+from sourmash.tax import tax_utils
+
+from ani_io import read_table_rows
+from metrics import metrics
+
+# per-process state for pool workers, set via init_worker
+worker_context = {}
+
+
+def init_worker(context):
+    worker_context.update(context)
+    # forked workers report only what they record themselves (see metrics.take)
+    metrics.take()
+
+
+def imap_bounded(func, items, processes, context=None, max_pending=None):
+    """
+    Ordered parallel map: yield func(item) for each item, in input order.
+
+    At most max_pending results are outstanding at once, so a slow consumer
+    (e.g. the single db/csv writer) bounds the memory used by finished
+    results. `context` is made available to workers as `worker_context`.
+    Uses fork so large read-only objects (e.g. taxonomy) are shared, not pickled.
+    """
+    if max_pending is None:
+        max_pending = processes * 4
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(processes, initializer=init_worker, initargs=(context or {},)) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+class IdentIndex:
+    "Intern genome identifiers to small integer ids, optionally starting from an existing {ident: id} map."
+    def __init__(self, ids=None):
+        self.ids = dict(ids or {})
+        self.next_id = max(self.ids.values(), default=-1) + 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_id(self, ident):
+        gid = self.ids.get(ident)
+        if gid is None:
+            gid = self.ids[ident] = self.next_id
+            self.next_id += 1
+        return gid
+
+
+def pair_keys(idents, id_pairs):
+    """
+    Pack (ident1, ident2) pairs into canonical uint64 keys: (min_id << 32) | max_id,
+    so A_x_B and B_x_A share a key.
+    """
+    ids = np.fromiter((idents.get_id(x) for pair in id_pairs for x in pair), dtype=np.uint64)
+    ids = ids.reshape(-1, 2)
+    return (ids.min(axis=1) << np.uint64(32)) | ids.max(axis=1)
+
+
+class PairSet:
+    """
+    Compact set of pair keys (see pair_keys): 8 bytes per pair.
+
+    Keys are held as a few sorted numpy runs; a new run is added per batch
+    and runs of similar size are merged, so inserts stay amortised O(log n).
+    """
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def _found(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            idx = np.searchsorted(run, keys)
+            idx[idx == len(run)] = 0
+            found |= run[idx] == keys
+        return found
+
+    def add_new(self, keys):
+        """
+        Add a batch of keys. Return a boolean mask marking the keys that were not
+        already present -- for repeats within the batch, only the first occurrence.
+        """
+        is_new = np.zeros(len(keys), dtype=bool)
+        if not len(keys):
+            return is_new
+        uniq, first_idx = np.unique(keys, return_index=True)
+        found = self._found(uniq)
+        is_new[first_idx[~found]] = True
+        new_keys = uniq[~found]
+        if len(new_keys):
+            self.runs.append(new_keys)
+            while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+                last = self.runs.pop()
+                merged = np.concatenate([self.runs.pop(), last])
+                merged.sort(kind="mergesort")
+                self.runs.append(merged)
+        return is_new
+
+
+def filter_seen(rows, comparisons, idents):
+    """
+    Drop rows whose comparison (in either orientation) is already in the
+    PairSet `comparisons`, recording new ones. rows are (ident1, ident2, ...)
+    """
+    is_new = comparisons.add_new(pair_keys(idents, ((row[0], row[1]) for row in rows)))
+    # rows with no info (already counted as filtered / missing a lineage by the worker) aren't counted again
+    metrics.count("rows_duplicate", sum(1 for row, new in zip(rows, is_new) if not new and row[-1] is not None))
+    return [row for row, new in zip(rows, is_new) if new]
+
+
+def containment_to_ani(containment, ksize, scaled, n_unique_kmers):
+    """
+    Vectorised 1 - containment_to_distance(...).dist over arrays.
+
+    The point estimate is 1 - c**(1/ksize) and only depends on ksize; values
+    at or near 0/1 (which sourmash special-cases, with version-dependent
+    cutoffs) and out-of-range values go through containment_to_distance itself.
+    """
+    containment = np.asarray(containment, dtype=np.float64)
+    ksize = np.broadcast_to(np.asarray(ksize, dtype=np.float64), containment.shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dist = 1.0 - containment ** (1.0 / ksize)
+    edge = np.flatnonzero((containment <= 0.0001) | (containment >= 0.9999) | np.isnan(containment))
+    scaled = np.broadcast_to(scaled, containment.shape)
+    n_unique_kmers = np.broadcast_to(n_unique_kmers, containment.shape)
+    for n in edge:
+        dist[n] = containment_to_distance(float(containment[n]), int(ksize[n]), int(scaled[n]),
+                                          n_unique_kmers=int(n_unique_kmers[n])).dist
+    return 1.0 - dist
+
+
+def pair_sort_key(ident1, ident2):
+    "canonical (unordered) key for a comparison"
+    return (ident1, ident2) if ident1 <= ident2 else (ident2, ident1)
+
+
+def _spill_run(records, tmpdir=None):
+    run = tempfile.TemporaryFile(mode='w+', newline='', dir=tmpdir)
+    csv.writer(run).writerows(records)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    for row in csv.reader(run):
+        row[2] = int(row[2])
+        yield tuple(row)
+
+
+def external_sort(records, chunk_size=2000000, tmpdir=None):
+    """
+    Sort (key1, key2, seq, *fields) records -- str keys/fields, int seq --
+    holding at most chunk_size records in memory. Full chunks are sorted and
+    spilled to temporary csv runs, which are then k-way merged.
+    """
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            chunk.sort()
+            runs.append(_spill_run(chunk, tmpdir))
+            chunk = []
+    chunk.sort()
+    if not runs:
+        yield from chunk
+        return
+    runs.append(_spill_run(chunk, tmpdir))
+    try:
+        yield from heapq.merge(*[_read_run(run) for run in runs])
+    finally:
+        for run in runs:
+            run.close()
+
+
+def sorted_pair_rows(csv_file, fields, sort_chunk_size=2000000, tmpdir=None):
+    """
+    Read an LCA-ANI csv/parquet table as (pair key, seq, *fields) records,
+    externally sorted on the unordered (query, match) ident pair.
+    """
+    def records():
+        columns = ["query_name", "match_name"] + [f for f in fields if f not in ("query_name", "match_name")]
+        # names repeat across rows: parse each distinct name once
+        ident_of = {}
+        for n, row in enumerate(read_table_rows(csv_file, columns=columns)):
+            if n % 500000 == 0:
+                notify(f"{csv_file}: row {n}")
+            query = ident_of.get(row["query_name"])
+            if query is None:
+                query = ident_of[row["query_name"]] = tax_utils.get_ident(row["query_name"])
+            match = ident_of.get(row["match_name"])
+            if match is None:
+                match = ident_of[row["match_name"]] = tax_utils.get_ident(row["match_name"])
+            yield pair_sort_key(query, match) + (n,) + tuple(row[f] for f in fields)
+    return external_sort(records(), chunk_size=sort_chunk_size, tmpdir=tmpdir)
+
+
+def merge_join(left, right):
+    """
+    Inner join of two external_sort outputs on (key1, key2). Where a key
+    repeats on one side, the last record (highest seq) wins. Yields
+    (left_record, right_record).
+    """
+    left_groups = itertools.groupby(left, key=lambda rec: rec[:2])
+    right_groups = itertools.groupby(right, key=lambda rec: rec[:2])
+    left_key, left_recs = next(left_groups, (None, None))
+    right_key, right_recs = next(right_groups, (None, None))
+    while left_key is not None and right_key is not None:
+        if left_key < right_key:
+            left_key, left_recs = next(left_groups, (None, None))
+        elif right_key < left_key:
+            right_key, right_recs = next(right_groups, (None, None))
+        else:
+            yield deque(left_recs, maxlen=1)[0], deque(right_recs, maxlen=1)[0]
+            left_key, left_recs = next(left_groups, (None, None))
+            right_key, right_recs = next(right_groups, (None, None))
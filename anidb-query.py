@@ -0,0 +1,199 @@
+
+# query an LCA-ANI database from the command line, or serve the same queries over local HTTP (read-only)
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from sourmash.logging import notify
+
+from ani_io import open_table
+from ani_query import AniQuery, REPORT_COLUMNS
+
+LINEAGE_FIELDS = ["query", "rank", "lca_name"] + REPORT_COLUMNS
+GENOME_FIELDS = ["query", "ident", "name", "lca_rank", "lca_name", "ani"]
+
+
+def read_queries(args):
+    queries = list(args.queries)
+    if args.from_file:
+        queries += [x.strip() for x in open(args.from_file, 'r') if x.strip()]
+    return queries
+
+
+def open_output(path):
+    # stdout is left open when the `with` block ends
+    return open_table(path, 'w') if path else contextlib.nullcontext(sys.stdout)
+
+
+def lineage_cmd(query, args):
+    results = query.lineage_stats_batch(read_queries(args))
+    with open_output(args.output) as fp:
+        w = csv.DictWriter(fp, fieldnames=LINEAGE_FIELDS)
+        w.writeheader()
+        for name, found in results.items():
+            if not found:
+                notify(f"{name} is not an LCA lineage in '{args.anidb}'")
+            for stats in found:
+                w.writerow(dict(query=name, **stats))
+
+
+def write_comparisons(results, args):
+    with open_output(args.output) as fp:
+        w = csv.DictWriter(fp, fieldnames=GENOME_FIELDS)
+        w.writeheader()
+        for ident, found in results.items():
+            if found is None:
+                notify(f"{ident} is not in '{args.anidb}'")
+                continue
+            for comparison in found:
+                w.writerow(dict(query=ident, **comparison))
+
+
+def genome_cmd(query, args):
+    write_comparisons(query.genome_comparisons_batch(read_queries(args), min_ani=args.min_ani, limit=args.limit), args)
+
+
+def neighbors_cmd(query, args):
+    write_comparisons(query.nearest_neighbors_batch(read_queries(args), k=args.k), args)
+
+
+def rank_cmd(query, args):
+    with open_output(args.output) as fp:
+        w = csv.DictWriter(fp, fieldnames=["rank"] + REPORT_COLUMNS)
+        w.writeheader()
+        for rank, stats in query.rank_stats().items():
+            w.writerow(dict(rank=rank, **stats))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints:
+      GET  /ranks                                      per-rank stats
+      GET  /lineages/<name>                            stats for one LCA lineage
+      POST /lineages  {"names": [...]}                 stats for many lineages
+      GET  /genomes/<ident>?min_ani=&limit=            comparisons for one genome
+      POST /genomes   {"idents": [...], "min_ani", "limit"}
+      GET  /neighbors/<ident>?k=                       k nearest neighbors of one genome
+      POST /neighbors {"idents": [...], "k"}
+      GET  /cache                                      result cache size + hit rate
+    """
+    query = None
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/', 1)]
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        try:
+            if parts == ["ranks"]:
+                return self.send_json(self.query.rank_stats())
+            if parts == ["cache"]:
+                return self.send_json(self.query.cache_info())
+            if len(parts) == 2 and parts[0] == "lineages":
+                found = self.query.lineage_stats(parts[1])
+                return self.send_json(found, status=200 if found else 404)
+            if len(parts) == 2 and parts[0] == "genomes":
+                found = self.query.genome_comparisons(parts[1], min_ani=float(params["min_ani"]) if "min_ani" in params else None,
+                                                      limit=int(params["limit"]) if "limit" in params else None)
+                return self.send_json(found, status=200 if found is not None else 404)
+            if len(parts) == 2 and parts[0] == "neighbors":
+                found = self.query.nearest_neighbors(parts[1], k=int(params.get("k", 10)))
+                return self.send_json(found, status=200 if found is not None else 404)
+        except ValueError as e:
+            return self.send_json({"error": str(e)}, status=400)
+        except sqlite3.Error as e:
+            return self.send_json({"error": f"database error: {e}"}, status=500)
+        self.send_json({"error": f"unknown path '{url.path}'"}, status=404)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path.strip('/')
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if path == "lineages":
+                return self.send_json(self.query.lineage_stats_batch(request["names"]))
+            if path == "genomes":
+                min_ani, limit = request.get("min_ani"), request.get("limit")
+                return self.send_json(self.query.genome_comparisons_batch(request["idents"],
+                                                                          min_ani=float(min_ani) if min_ani is not None else None,
+                                                                          limit=int(limit) if limit is not None else None))
+            if path == "neighbors":
+                return self.send_json(self.query.nearest_neighbors_batch(request["idents"], k=int(request.get("k", 10))))
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json({"error": f"bad request: {e!r}"}, status=400)
+        except sqlite3.Error as e:
+            return self.send_json({"error": f"database error: {e}"}, status=500)
+        self.send_json({"error": f"unknown path '{path}'"}, status=404)
+
+
+def serve_cmd(query, args):
+    QueryHandler.query = query
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    notify(f"serving '{args.anidb}' on http://{args.host}:{server.server_port}/ (read-only)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args):
+    query = AniQuery(args.anidb, pool_size=args.pool_size, cache_size=args.cache_size, mmap_mb=args.mmap_mb)
+    try:
+        args.func(query, args)
+    finally:
+        query.close()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('anidb', help='ANI SQLite database')
+    p.add_argument('--pool-size', type=int, default=8, help='number of read-only database connections')
+    p.add_argument('--cache-size', type=int, default=100000, help='number of query results to keep in the LRU cache')
+    p.add_argument('--mmap-mb', type=int, default=1024, help='memory-map up to this many MB of the database per connection')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    s = sub.add_parser('lineage', help='ANI stats for LCA lineages')
+    s.add_argument('queries', nargs='*', help='LCA lineage names, e.g. g__Escherichia')
+    s.add_argument('--from-file', help='file containing lineage names, one per line')
+    s.add_argument('-o', '--output', help='CSV output (default: stdout)')
+    s.set_defaults(func=lineage_cmd)
+
+    s = sub.add_parser('genome', help='all comparisons for genomes')
+    s.add_argument('queries', nargs='*', help='genome identifiers (any version, GCA_/GCF_) or names')
+    s.add_argument('--from-file', help='file containing genome identifiers, one per line')
+    s.add_argument('--min-ani', type=float, help='only report comparisons with at least this ANI')
+    s.add_argument('--limit', type=int, help='report at most this many comparisons per genome (highest ANI first)')
+    s.add_argument('-o', '--output', help='CSV output (default: stdout)')
+    s.set_defaults(func=genome_cmd)
+
+    s = sub.add_parser('neighbors', help='nearest neighbors (highest ANI) of genomes')
+    s.add_argument('queries', nargs='*', help='genome identifiers (any version, GCA_/GCF_) or names')
+    s.add_argument('--from-file', help='file containing genome identifiers, one per line')
+    s.add_argument('-k', type=int, default=10, help='number of neighbors to report per genome')
+    s.add_argument('-o', '--output', help='CSV output (default: stdout)')
+    s.set_defaults(func=neighbors_cmd)
+
+    s = sub.add_parser('rank', help='ANI stats per LCA rank')
+    s.add_argument('-o', '--output', help='CSV output (default: stdout)')
+    s.set_defaults(func=rank_cmd)
+
+    s = sub.add_parser('serve', help='serve queries as JSON over HTTP')
+    s.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    s.add_argument('--port', type=int, default=8765)
+    s.set_defaults(func=serve_cmd)
+
+    args = p.parse_args()
+    sys.exit(main(args))
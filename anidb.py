@@ -0,0 +1,527 @@
+# LCA-ANI sqlite database: schema, bulk loading and summary tables
+import os
+import time
+import hashlib
+from urllib.parse import quote
+
+import numpy as np
+
+from sourmash.lca import lca_utils
+from sourmash.logging import notify
+
+from ani_utils import IdentIndex, pair_sort_key
+from metrics import metrics
+from ani_stats import AniStats, QUANTILE_NAMES, stats_by_sorted_group
+
+# columns of rank_summary / lineage_summary after the id; see ani_stats.AniStats.summary
+STAT_COLUMNS = ["n", "min_ani", "avg_ani", "max_ani", "std_ani"] + \
+               [f"{q}_ani" for q in QUANTILE_NAMES] + ["sum_ani", "sum_sq_ani"]
+
+# genomes, ranks and LCA lineages are stored once and referenced by integer id;
+# `comparisons` keeps the original (ident1, ident2, lca_rank, lca_name, ani) layout as a view.
+# prefetch_files is the manifest of loaded prefetch csvs; each comparison records the file it came from.
+# prefetch_queries lists each file's query genomes (a prefetch csv only holds their comparisons), and
+# pending_rescan the comparisons deleted with changed files until other files have been re-read for them.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS genomes (genome_id INTEGER PRIMARY KEY,
+                                    ident TEXT NOT NULL UNIQUE,
+                                    name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ranks (rank_id INTEGER PRIMARY KEY,
+                                  rank TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS lineages (lineage_id INTEGER PRIMARY KEY,
+                                     rank_id INTEGER NOT NULL REFERENCES ranks (rank_id),
+                                     name TEXT NOT NULL,
+                                     UNIQUE (rank_id, name));
+CREATE TABLE IF NOT EXISTS prefetch_files (file_id INTEGER PRIMARY KEY,
+                                           path TEXT NOT NULL UNIQUE,
+                                           size INTEGER NOT NULL,
+                                           mtime_ns INTEGER NOT NULL,
+                                           md5 TEXT NOT NULL,
+                                           n_comparisons INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS prefetch_queries (ident TEXT NOT NULL,
+                                             file_id INTEGER NOT NULL REFERENCES prefetch_files (file_id),
+                                             PRIMARY KEY (ident, file_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pending_rescan (ident1 TEXT NOT NULL,
+                                           ident2 TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ani_comparisons (genome_id1 INTEGER NOT NULL,
+                                            genome_id2 INTEGER NOT NULL,
+                                            rank_id INTEGER NOT NULL,
+                                            lineage_id INTEGER NOT NULL,
+                                            ani REAL NOT NULL,
+                                            file_id INTEGER REFERENCES prefetch_files (file_id));
+CREATE VIEW IF NOT EXISTS comparisons AS
+    SELECT g1.name AS ident1, g2.name AS ident2, r.rank AS lca_rank, l.name AS lca_name, c.ani AS ani
+    FROM ani_comparisons c
+    JOIN genomes g1 ON g1.genome_id = c.genome_id1
+    JOIN genomes g2 ON g2.genome_id = c.genome_id2
+    JOIN ranks r ON r.rank_id = c.rank_id
+    JOIN lineages l ON l.lineage_id = c.lineage_id;
+CREATE TABLE IF NOT EXISTS rank_summary (rank_id INTEGER PRIMARY KEY,
+                                         n INTEGER NOT NULL,
+                                         min_ani REAL,
+                                         avg_ani REAL,
+                                         max_ani REAL,
+                                         std_ani REAL,
+                                         q05_ani REAL,
+                                         q25_ani REAL,
+                                         median_ani REAL,
+                                         q75_ani REAL,
+                                         q95_ani REAL,
+                                         sum_ani REAL,
+                                         sum_sq_ani REAL);
+CREATE TABLE IF NOT EXISTS genome_neighbors (genome_id INTEGER PRIMARY KEY,
+                                             n_neighbors INTEGER NOT NULL,
+                                             neighbors BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS lineage_summary (lineage_id INTEGER PRIMARY KEY,
+                                            n INTEGER NOT NULL,
+                                            min_ani REAL,
+                                            avg_ani REAL,
+                                            max_ani REAL,
+                                            std_ani REAL,
+                                            q05_ani REAL,
+                                            q25_ani REAL,
+                                            median_ani REAL,
+                                            q75_ani REAL,
+                                            q95_ani REAL,
+                                            sum_ani REAL,
+                                            sum_sq_ani REAL);
+'''
+
+# genome_neighbors holds each genome's top-k comparisons, highest ANI first, packed as a
+# NEIGHBOR_DTYPE array; n_neighbors is the genome's total number of comparisons
+NEIGHBOR_DTYPE = np.dtype([("genome_id", "<i4"), ("lineage_id", "<i4"), ("ani", "<f4")])
+DEFAULT_TOP_K = 50
+
+# built after the bulk load -- much faster than maintaining them row by row.
+# (rank_id, ani) / (lineage_id, ani) cover the per-rank and per-lineage stats queries,
+# genome_id1 / genome_id2 the per-genome lookups in ani_query.py
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS ani_comparisons_rank_ani ON ani_comparisons (rank_id, ani);
+CREATE INDEX IF NOT EXISTS ani_comparisons_lineage_ani ON ani_comparisons (lineage_id, ani);
+CREATE INDEX IF NOT EXISTS ani_comparisons_genome1 ON ani_comparisons (genome_id1);
+CREATE INDEX IF NOT EXISTS ani_comparisons_genome2 ON ani_comparisons (genome_id2);
+'''
+
+
+def set_bulk_pragmas(db, journal_mode="wal", cache_mb=512, page_size=32768):
+    # page_size only takes effect on a fresh db (before any table is created)
+    db.execute(f"PRAGMA page_size={int(page_size)}")
+    db.execute(f"PRAGMA journal_mode={journal_mode}")
+    db.execute("PRAGMA synchronous=OFF")
+    # negative cache_size is in KiB
+    db.execute(f"PRAGMA cache_size={-int(cache_mb) * 1024}")
+    db.execute("PRAGMA temp_store=MEMORY")
+
+
+def readonly_uri(path):
+    "sqlite URI opening `path` read-only; quoted, so '?', '#' and '%' in the path are taken literally"
+    return f"file:{quote(os.path.abspath(path))}?mode=ro"
+
+
+def has_table(db, name):
+    found = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+    return found is not None
+
+
+def count_comparisons(db):
+    """
+    Comparisons already in `db` (0 if it has no tables yet). Scripts check
+    this before set_bulk_pragmas, so refusing to add to a finished db
+    doesn't leave it in WAL mode.
+    """
+    if not has_table(db, "ani_comparisons"):
+        return 0
+    return db.execute("SELECT COUNT(*) FROM ani_comparisons").fetchone()[0]
+
+
+def create_schema(db):
+    db.executescript(SCHEMA)
+    # rank ids follow taxonomic order, superkingdom first
+    db.executemany("INSERT OR IGNORE INTO ranks (rank_id, rank) VALUES (?, ?)",
+                   enumerate(lca_utils.taxlist(include_strain=True)))
+    db.commit()
+
+
+def file_md5(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class PrefetchFile:
+    """
+    one prefetch csv to load, and its manifest entry. A `rescan` file is
+    unchanged, and is re-read only for comparisons removed along with changed
+    files; `n_loaded` of its comparisons are already in the db.
+    """
+    def __init__(self, file_id, path, size, mtime_ns, md5=None, n_loaded=0, rescan=False):
+        self.file_id = file_id
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.md5 = md5
+        self.n_loaded = n_loaded
+        self.rescan = rescan
+
+
+def plan_prefetch_files(db, paths):
+    """
+    Compare prefetch csvs against the prefetch_files manifest and return
+    (to_load, removed_pairs). to_load are the PrefetchFiles that need loading:
+    new files, and files whose contents changed. A file is unchanged if its
+    size and mtime match, or failing that, its md5.
+
+    Rows previously loaded from changed files are deleted. Other files may
+    hold some of those comparisons, skipped as duplicates when they were
+    loaded; the unchanged files in the manifest whose query genomes are in
+    any of them are also re-read (as `rescan` PrefetchFiles, in path order)
+    for the `removed_pairs` -- a set of pair_sort_key ident pairs -- they hold.
+    The removed pairs are kept in pending_rescan, committed with the delete,
+    until finish_rescan(): if a run stops before the rescans are done, the
+    next one picks them up.
+    """
+    manifest = dict((path, (file_id, size, mtime_ns, md5, n)) for file_id, path, size, mtime_ns, md5, n
+                    in db.execute("SELECT file_id, path, size, mtime_ns, md5, n_comparisons FROM prefetch_files"))
+    next_file_id = max((entry[0] for entry in manifest.values()), default=0) + 1
+    planned = []
+    changed = []
+    seen = set()
+    # files already loaded but not listed this time can hold removed comparisons too
+    listed_paths = [os.path.abspath(path) for path in paths]
+    unlisted = set(manifest) - set(listed_paths)
+    for path in listed_paths + sorted(unlisted):
+        if path in seen:
+            continue
+        seen.add(path)
+        entry = manifest.get(path)
+        if entry is None:
+            # md5 is taken while the file is read
+            st = os.stat(path)
+            planned.append(PrefetchFile(next_file_id, path, st.st_size, st.st_mtime_ns))
+            next_file_id += 1
+            continue
+        file_id, size, mtime_ns, md5, n_loaded = entry
+        listed = path not in unlisted
+        if not listed and not os.path.exists(path):
+            continue
+        st = os.stat(path)
+        new_md5 = None
+        if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+            new_md5 = file_md5(path)
+            if new_md5 == md5:
+                # touched, not modified
+                db.execute("UPDATE prefetch_files SET size = ?, mtime_ns = ? WHERE file_id = ?",
+                           (st.st_size, st.st_mtime_ns, file_id))
+        if new_md5 is None or new_md5 == md5:
+            planned.append(PrefetchFile(file_id, path, st.st_size, st.st_mtime_ns, md5, n_loaded, rescan=True))
+        elif listed:
+            changed.append(file_id)
+            planned.append(PrefetchFile(file_id, path, st.st_size, st.st_mtime_ns, new_md5))
+        else:
+            notify(f"WARNING: '{path}' has changed since it was loaded; list it to reload it")
+
+    to_load = [pf for pf in planned if not pf.rescan]
+    n_unchanged = sum(1 for pf in planned if pf.rescan and pf.path not in unlisted)
+    n_new = len(to_load) - len(changed)
+    notify(f"{n_unchanged} prefetch files unchanged; loading {n_new} new and {len(changed)} changed files")
+    # left by an earlier run that stopped before its rescans were done
+    removed_pairs = set(db.execute("SELECT ident1, ident2 FROM pending_rescan"))
+    if changed:
+        # one pass over ani_comparisons, rather than one per changed file
+        db.execute("CREATE TEMP TABLE changed_files (file_id INTEGER PRIMARY KEY)")
+        db.executemany("INSERT INTO changed_files VALUES (?)", ((file_id,) for file_id in changed))
+        db.execute("CREATE TEMP TABLE removed AS SELECT rowid AS row_id, genome_id1, genome_id2 FROM ani_comparisons "
+                   "WHERE file_id IN (SELECT file_id FROM changed_files)")
+        n = db.execute("DELETE FROM ani_comparisons WHERE rowid IN (SELECT row_id FROM removed)").rowcount
+        pairs = [pair_sort_key(ident1, ident2) for ident1, ident2
+                 in db.execute("SELECT g1.ident, g2.ident FROM removed r "
+                               "JOIN genomes g1 ON g1.genome_id = r.genome_id1 "
+                               "JOIN genomes g2 ON g2.genome_id = r.genome_id2")]
+        db.executemany("INSERT INTO pending_rescan (ident1, ident2) VALUES (?, ?)", pairs)
+        removed_pairs.update(pairs)
+        db.execute("DROP TABLE changed_files")
+        db.execute("DROP TABLE removed")
+        notify(f"removed {n} comparisons loaded from previous versions of changed files")
+    db.commit()
+    if removed_pairs:
+        # files with no recorded queries (empty, or loaded before prefetch_queries existed) are always re-read
+        genomes = set(ident for pair in removed_pairs for ident in pair)
+        rescan_ids = set(file_id for file_id, in db.execute("SELECT file_id FROM prefetch_files "
+                                                            "WHERE file_id NOT IN (SELECT file_id FROM prefetch_queries)"))
+        for ident in genomes:
+            rescan_ids.update(file_id for file_id, in db.execute("SELECT file_id FROM prefetch_queries WHERE ident = ?", (ident,)))
+        to_load = [pf for pf in planned if not pf.rescan or pf.file_id in rescan_ids]
+        notify(f"re-reading {len(to_load) - len(changed) - n_new} unchanged files for {len(removed_pairs)} removed comparisons")
+    return to_load, removed_pairs
+
+
+def finish_rescan(db):
+    "all files that could hold the pending_rescan comparisons have been re-read: clear them"
+    db.execute("DELETE FROM pending_rescan")
+    db.commit()
+
+
+def load_genome_idents(db):
+    "IdentIndex whose ids are the genome_ids already in the db"
+    return IdentIndex(db.execute("SELECT ident, genome_id FROM genomes"))
+
+
+def load_existing_pairs(db, comparisons, chunk_size=1000000):
+    "add the (genome_id1, genome_id2) pairs already in the db to the PairSet `comparisons`"
+    cursor = db.execute("SELECT genome_id1, genome_id2 FROM ani_comparisons")
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        ids = np.array(chunk, dtype=np.uint64)
+        comparisons.add_new((ids.min(axis=1) << np.uint64(32)) | ids.max(axis=1))
+    notify(f"loaded {len(comparisons)} existing comparisons")
+
+
+def summary_row(stats):
+    return stats.summary() + [float(stats.sum), float(stats.sum_sq)]
+
+
+def rebuild_summaries(db, n_bins=1000):
+    """
+    Recompute rank_summary and lineage_summary from ani_comparisons in one
+    pass over the (lineage_id, ani) index; rank stats are merged from their lineages.
+    """
+    db.executescript(INDEXES)
+    lineage_ranks = dict(db.execute("SELECT lineage_id, rank_id FROM lineages"))
+    rank_stats = {}
+    lineage_rows = []
+    cursor = db.execute("SELECT lineage_id, ani FROM ani_comparisons ORDER BY lineage_id")
+    for (lineage_id,), stats in stats_by_sorted_group(cursor, n_bins=n_bins):
+        lineage_rows.append([lineage_id] + summary_row(stats))
+        rank_id = lineage_ranks[lineage_id]
+        if rank_id not in rank_stats:
+            rank_stats[rank_id] = AniStats(n_bins=n_bins)
+        rank_stats[rank_id].merge(stats)
+    rank_rows = [[rank_id] + summary_row(stats) for rank_id, stats in rank_stats.items()]
+
+    placeholders = ", ".join("?" * (len(STAT_COLUMNS) + 1))
+    db.execute("DELETE FROM lineage_summary")
+    db.executemany(f"INSERT INTO lineage_summary VALUES ({placeholders})", lineage_rows)
+    db.execute("DELETE FROM rank_summary")
+    db.executemany(f"INSERT INTO rank_summary VALUES ({placeholders})", rank_rows)
+    db.commit()
+
+
+def rebuild_neighbors(db, top_k=DEFAULT_TOP_K, block_rows=5000000, chunk_size=1000000):
+    """
+    Recompute genome_neighbors: for each genome, its top_k comparisons by ANI
+    (ties by genome id). Genomes are taken in blocks of consecutive ids with
+    about `block_rows` comparisons between them (counted from the genome
+    indexes), so memory doesn't depend on the size of the db. Each block's
+    comparisons are read through the indexes, `chunk_size` rows at a time,
+    into arrays of the stored (int32, float32) types.
+    """
+    db.executescript(INDEXES)
+    db.execute("DELETE FROM genome_neighbors")
+    max_genome_id = db.execute("SELECT MAX(genome_id) FROM genomes").fetchone()[0]
+    counts = np.zeros((max_genome_id or 0) + 1, dtype=np.int64)
+    for column in ("genome_id1", "genome_id2"):
+        for genome_id, n in db.execute(f"SELECT {column}, COUNT(*) FROM ani_comparisons GROUP BY {column}"):
+            counts[genome_id] += n
+    ends = np.cumsum(counts)
+    n_genomes = 0
+    lo = 0
+    while lo < len(counts):
+        # at least one genome per block, however many comparisons it has
+        start = ends[lo] - counts[lo]
+        hi = max(int(np.searchsorted(ends, start + block_rows, side='right')), lo + 1)
+        n_rows = int(ends[hi - 1] - start)
+        if n_rows:
+            genome_id = np.empty(n_rows, dtype=np.int32)
+            other = np.empty(n_rows, dtype=np.int32)
+            lineage_id = np.empty(n_rows, dtype=np.int32)
+            ani = np.empty(n_rows, dtype=np.float32)
+            cursor = db.execute("SELECT genome_id1, genome_id2, lineage_id, ani FROM ani_comparisons WHERE genome_id1 >= :lo AND genome_id1 < :hi "
+                                "UNION ALL "
+                                "SELECT genome_id2, genome_id1, lineage_id, ani FROM ani_comparisons WHERE genome_id2 >= :lo AND genome_id2 < :hi",
+                                {"lo": lo, "hi": hi})
+            n = 0
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                for column, values in zip((genome_id, other, lineage_id, ani), zip(*chunk)):
+                    column[n:n + len(chunk)] = values
+                n += len(chunk)
+            order = np.lexsort((other, -ani, genome_id))
+            genomes, starts, n_neighbors = np.unique(genome_id[order], return_index=True, return_counts=True)
+            neighbors = np.empty(len(order), dtype=NEIGHBOR_DTYPE)
+            neighbors["genome_id"] = other[order]
+            neighbors["lineage_id"] = lineage_id[order]
+            neighbors["ani"] = ani[order]
+            db.executemany("INSERT INTO genome_neighbors (genome_id, n_neighbors, neighbors) VALUES (?, ?, ?)",
+                           ((int(g), int(k), neighbors[start:start + min(k, top_k)].tobytes())
+                            for g, start, k in zip(genomes, starts, n_neighbors)))
+            n_genomes += len(genomes)
+        lo = hi
+    db.commit()
+    notify(f"stored the top {top_k} neighbors of {n_genomes} genomes")
+
+
+class AniDBWriter:
+    """
+    Batched writer for LCA-ANI comparisons.
+
+    Genome ids come from the shared IdentIndex used for pair dedup; rank and
+    lineage ids are assigned here. Rows are inserted with executemany and
+    committed every `batch_size` rows. finish() also stores each genome's
+    `top_k` nearest neighbors (0 to skip).
+    """
+    def __init__(self, db, idents, batch_size=100000, top_k=DEFAULT_TOP_K):
+        self.db = db
+        self.idents = idents
+        self.batch_size = batch_size
+        self.top_k = top_k
+        self.rank_ids = dict((rank, rank_id) for rank_id, rank in db.execute("SELECT rank_id, rank FROM ranks"))
+        self.lineage_ids = dict(((rank_id, name), lineage_id) for lineage_id, rank_id, name
+                                in db.execute("SELECT lineage_id, rank_id, name FROM lineages"))
+        self.genomes_written = set(genome_id for genome_id, in db.execute("SELECT genome_id FROM genomes"))
+        self.genomes = []
+        self.batch = []
+        self.files = []
+        self.queries = []
+        self.n_written = 0
+        self.start_time = time.perf_counter()
+
+    def get_genome_id(self, ident, name):
+        genome_id = self.idents.get_id(ident)
+        if genome_id not in self.genomes_written:
+            self.genomes_written.add(genome_id)
+            self.genomes.append((genome_id, ident, name))
+        return genome_id
+
+    def get_rank_id(self, rank):
+        rank_id = self.rank_ids.get(rank)
+        if rank_id is None:
+            rank_id = self.db.execute("INSERT INTO ranks (rank) VALUES (?)", (rank,)).lastrowid
+            self.rank_ids[rank] = rank_id
+        return rank_id
+
+    def get_lineage_id(self, rank_id, name):
+        lineage_id = self.lineage_ids.get((rank_id, name))
+        if lineage_id is None:
+            lineage_id = self.db.execute("INSERT INTO lineages (rank_id, name) VALUES (?, ?)",
+                                         (rank_id, name)).lastrowid
+            self.lineage_ids[(rank_id, name)] = lineage_id
+        return lineage_id
+
+    def add(self, ident1, name1, ident2, name2, lca_rank, lca_name, ani, file_id=None):
+        rank_id = self.get_rank_id(lca_rank)
+        self.batch.append((self.get_genome_id(ident1, name1), self.get_genome_id(ident2, name2),
+                           rank_id, self.get_lineage_id(rank_id, lca_name), ani, file_id))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def add_ids(self, rows):
+        "add (genome_id1, genome_id2, rank_id, lineage_id, ani, file_id) rows whose ids are already in this db"
+        self.batch.extend(rows)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def add_file(self, prefetch_file, n_comparisons, queries=()):
+        # committed with the file's last rows, so the manifest never lists a partly-written file.
+        # `queries` are the idents of the file's query genomes
+        pf = prefetch_file
+        self.files.append((pf.file_id, pf.path, pf.size, pf.mtime_ns, pf.md5, n_comparisons))
+        self.queries.extend((ident, pf.file_id) for ident in queries)
+
+    def flush(self):
+        # write one chunk of rows and commit it
+        with metrics.stage("db insert"):
+            self.db.executemany("INSERT INTO genomes (genome_id, ident, name) VALUES (?, ?, ?)", self.genomes)
+            self.db.executemany("INSERT INTO ani_comparisons (genome_id1, genome_id2, rank_id, lineage_id, ani, file_id) VALUES (?, ?, ?, ?, ?, ?)",
+                                self.batch)
+            self.db.executemany("INSERT OR REPLACE INTO prefetch_files (file_id, path, size, mtime_ns, md5, n_comparisons) VALUES (?, ?, ?, ?, ?, ?)",
+                                self.files)
+            self.db.executemany("DELETE FROM prefetch_queries WHERE file_id = ?", ((f[0],) for f in self.files))
+            self.db.executemany("INSERT OR IGNORE INTO prefetch_queries (ident, file_id) VALUES (?, ?)", self.queries)
+            self.db.commit()
+        self.n_written += len(self.batch)
+        metrics.count("rows_written", len(self.batch))
+        self.genomes = []
+        self.batch = []
+        self.files = []
+        self.queries = []
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.n_written / elapsed if elapsed > 0 else 0
+        notify(f"wrote {self.n_written} rows ({rate:.0f} rows/sec)")
+
+    def finish(self):
+        self.flush()
+        notify("building indexes and summary tables")
+        with metrics.stage("indexes + summaries"):
+            rebuild_summaries(self.db)
+        if self.top_k:
+            with metrics.stage("neighbors"):
+                rebuild_neighbors(self.db, self.top_k)
+
+
+def copy_shard(writer, comparisons, shard_path, chunk_size=1000000):
+    """
+    Bulk copy the comparisons and manifest of another LCA-ANI db (e.g. one
+    shard of a sharded build) into the writer's db. Genome, lineage and file
+    ids are remapped; pairs already in the PairSet `comparisons` are skipped,
+    so merging shards in order gives the same rows as one serial build.
+    """
+    db = writer.db
+    writer.flush()
+    db.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+
+    # shard id --> our id; shard genome ids can have gaps
+    max_genome_id = db.execute("SELECT MAX(genome_id) FROM shard.genomes").fetchone()[0]
+    genome_map = np.full((max_genome_id or 0) + 1, -1, dtype=np.int64)
+    for genome_id, ident, name in db.execute("SELECT genome_id, ident, name FROM shard.genomes").fetchall():
+        genome_map[genome_id] = writer.get_genome_id(ident, name)
+    max_lineage_id = db.execute("SELECT MAX(lineage_id) FROM shard.lineages").fetchone()[0]
+    lineage_map = np.full((max_lineage_id or 0) + 1, -1, dtype=np.int64)
+    lineage_rank = np.full_like(lineage_map, -1)
+    for lineage_id, rank, name in db.execute("SELECT l.lineage_id, r.rank, l.name FROM shard.lineages l "
+                                             "JOIN shard.ranks r ON r.rank_id = l.rank_id").fetchall():
+        rank_id = writer.get_rank_id(rank)
+        lineage_map[lineage_id] = writer.get_lineage_id(rank_id, name)
+        lineage_rank[lineage_id] = rank_id
+    file_offset = db.execute("SELECT COALESCE(MAX(file_id), 0) FROM prefetch_files").fetchone()[0]
+    shard_files = db.execute("SELECT file_id, path, size, mtime_ns, md5 FROM shard.prefetch_files").fetchall()
+    shard_queries = {}
+    if db.execute("SELECT 1 FROM shard.sqlite_master WHERE type='table' AND name='prefetch_queries'").fetchone():
+        for ident, file_id in db.execute("SELECT ident, file_id FROM shard.prefetch_queries"):
+            shard_queries.setdefault(file_id, []).append(ident)
+
+    n_read = 0
+    file_counts = {}
+    cursor = db.execute("SELECT genome_id1, genome_id2, lineage_id, ani, COALESCE(file_id, -1) "
+                        "FROM shard.ani_comparisons ORDER BY rowid")
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        n_read += len(chunk)
+        genome_id1, genome_id2, lineage_id, ani, file_id = zip(*chunk)
+        id1 = genome_map[np.array(genome_id1)]
+        id2 = genome_map[np.array(genome_id2)]
+        keys = (np.minimum(id1, id2).astype(np.uint64) << np.uint64(32)) | np.maximum(id1, id2).astype(np.uint64)
+        keep = np.flatnonzero(comparisons.add_new(keys))
+        lineage_id = np.array(lineage_id)[keep]
+        file_id = np.array(file_id, dtype=np.int64)[keep]
+        for f, n in zip(*np.unique(file_id, return_counts=True)):
+            file_counts[int(f)] = file_counts.get(int(f), 0) + int(n)
+        new_file_id = [None if f < 0 else f + file_offset for f in file_id.tolist()]
+        writer.add_ids(zip(id1[keep].tolist(), id2[keep].tolist(), lineage_rank[lineage_id].tolist(),
+                           lineage_map[lineage_id].tolist(), np.array(ani)[keep].tolist(), new_file_id))
+    for file_id, path, size, mtime_ns, md5 in shard_files:
+        writer.add_file(PrefetchFile(file_id + file_offset, path, size, mtime_ns, md5), file_counts.get(file_id, 0),
+                        shard_queries.get(file_id, ()))
+
+    writer.flush()
+    metrics.count("rows_read", n_read)
+    metrics.count("rows_duplicate", n_read - sum(file_counts.values()))
+    db.execute("DETACH DATABASE shard")
+    notify(f"copied {sum(file_counts.values())} of {n_read} comparisons from '{shard_path}'")
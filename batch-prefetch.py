@@ -0,0 +1,180 @@
+
+# compare many query genomes against a sourmash database, streaming the database once.
+# a batched replacement for one `sourmash sig grep {acc} | sourmash prefetch` job per accession
+import os
+import sys
+import csv
+import argparse
+import numpy as np
+import sourmash
+from sourmash.logging import notify
+from sourmash.picklist import SignaturePicklist
+
+from ani_utils import containment_to_ani
+from ani_io import open_table
+from sketch_index import SketchIndex, sketch_hashes
+
+# prefetch csv columns; the ANI columns are named as read by prefetch-to-lca-sql.py / prefetch-to-ani-csv.py
+PREFETCH_COLUMNS = ["intersect_bp", "jaccard", "max_containment", "f_query_match", "f_match_query",
+                    "match_filename", "match_name", "match_md5", "match_bp",
+                    "query_filename", "query_name", "query_md5", "query_bp",
+                    "ksize", "moltype", "scaled", "query_n_hashes", "query_ani", "match_ani"]
+
+
+def load_queries(database, accessions, ksize, moltype, scaled=None):
+    "index the sketches of `accessions` in `database`; returns (index, {accession: (sketch number, hashes)})"
+    picklist = SignaturePicklist('ident')
+    picklist.init(accessions)
+    index = SketchIndex(scaled=scaled)
+    queries = {}
+    for sig in sourmash.load_file_as_signatures(database, ksize=ksize, select_moltype=moltype, picklist=picklist):
+        n = index.add(sig, filename=database)
+        queries[sig.name.split(' ')[0]] = (n, sketch_hashes(index.downsample(sig.minhash)))
+    index.build()
+    return index, queries
+
+
+def find_matches(database, index, ksize, moltype, threshold_bp, chunk_size):
+    """
+    Stream every sketch in `database` once, counting the hashes it shares
+    with each query in `index`, `chunk_size` sketches at a time.
+
+    Returns (query, match, intersect) arrays for the pairs that pass
+    threshold_bp, sorted by query and then by match (numbered in database
+    order), and {match: (name, filename, md5, size, dataset_bp)} for the
+    sketches that matched anything. Only the queries are held in memory.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    found = [(empty, empty, empty)]
+    matches = {}
+
+    def compare(chunk, start):
+        overlaps = index.overlaps([hashes for sig, hashes in chunk]).tocoo()
+        intersect = overlaps.data.astype(np.int64)
+        keep = intersect * index.scaled >= threshold_bp
+        match = overlaps.row[keep].astype(np.int64) + start
+        found.append((overlaps.col[keep].astype(np.int64), match, intersect[keep]))
+        for m in np.unique(match).tolist():
+            sig, hashes = chunk[m - start]
+            # as in SketchIndex.add: size after downsampling, genome size from the sketch as given
+            matches[m] = (sig.name, sig.filename or database, sig.md5sum(), len(hashes),
+                          sig.minhash.unique_dataset_hashes)
+
+    chunk, n = [], 0
+    for sig in sourmash.load_file_as_signatures(database, ksize=ksize, select_moltype=moltype):
+        chunk.append((sig, sketch_hashes(index.downsample(sig.minhash))))
+        n += 1
+        if len(chunk) == chunk_size:
+            compare(chunk, n - len(chunk))
+            chunk = []
+        if n % 10000 == 0:
+            notify(f"compared {n} sketches; {len(matches)} matched a query")
+    if chunk:
+        compare(chunk, n - len(chunk))
+    notify(f"compared {n} sketches; {len(matches)} matched a query")
+
+    query, match, intersect = (np.concatenate(x) for x in zip(*found))
+    order = np.lexsort((match, query))
+    return query[order], match[order], intersect[order], matches
+
+
+def prefetch_rows(index, acc, query, match, intersect, matches):
+    "prefetch rows for one query from its (match, intersect) arrays; matches named like `acc` are excluded"
+    query_n, hashes = query
+    query_size = len(hashes)
+    match_size = np.array([matches[m][3] for m in match.tolist()], dtype=np.int64)
+    # as in sourmash prefetch, the query is downsampled before comparison; matches are not
+    query_bp = query_size * index.scaled
+    match_bp = np.array([matches[m][4] for m in match.tolist()], dtype=np.int64)
+    f_match_query = intersect / query_size
+    f_query_match = intersect / match_size
+    query_ani = containment_to_ani(f_match_query, index.ksize, index.scaled, query_bp)
+    match_ani = containment_to_ani(f_query_match, index.ksize, index.scaled, match_bp)
+    jaccard = intersect / (query_size + match_size - intersect)
+    max_containment = np.maximum(f_match_query, f_query_match)
+
+    for n, m in enumerate(match.tolist()):
+        match_name, match_filename, match_md5 = matches[m][:3]
+        if acc in match_name:
+            continue
+        yield {"intersect_bp": int(intersect[n]) * index.scaled,
+               "jaccard": jaccard[n],
+               "max_containment": max_containment[n],
+               "f_query_match": f_query_match[n],
+               "f_match_query": f_match_query[n],
+               "match_filename": match_filename,
+               "match_name": match_name,
+               "match_md5": match_md5[:8],
+               "match_bp": int(match_bp[n]),
+               "query_filename": index.filenames[query_n],
+               "query_name": index.names[query_n],
+               "query_md5": index.md5s[query_n][:8],
+               "query_bp": query_bp,
+               "ksize": index.ksize,
+               "moltype": index.moltype,
+               "scaled": index.scaled,
+               "query_n_hashes": query_size,
+               "query_ani": query_ani[n],
+               "match_ani": match_ani[n]}
+
+
+def main(args):
+    accessions = list(args.accessions)
+    if args.from_file:
+        accessions += [x.strip() for x in open(args.from_file, 'r') if x.strip()]
+    accessions = list(dict.fromkeys(accessions))
+
+    notify(f"loading the sketches of {len(accessions)} queries from '{args.database}'")
+    index, queries = load_queries(args.database, set(accessions), args.ksize, args.moltype, args.scaled)
+    for acc in accessions:
+        if acc not in queries:
+            notify(f"WARNING: {acc} not found in '{args.database}'")
+    query, match, intersect, matches = find_matches(args.database, index, args.ksize, args.moltype,
+                                                    args.threshold_bp, args.chunk_size)
+
+    combined = None
+    if args.output:
+        combined_fp = open_table(args.output, 'w')
+        combined = csv.DictWriter(combined_fp, fieldnames=PREFETCH_COLUMNS)
+        combined.writeheader()
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    n_rows = 0
+    for acc in accessions:
+        if acc not in queries:
+            continue
+        start, stop = np.searchsorted(query, [queries[acc][0], queries[acc][0] + 1])
+        rows = list(prefetch_rows(index, acc, queries[acc], match[start:stop], intersect[start:stop], matches))
+        n_rows += len(rows)
+        if combined is not None:
+            combined.writerows(rows)
+        if args.outdir:
+            with open_table(os.path.join(args.outdir, f"{acc}{args.suffix}"), 'w') as fp:
+                w = csv.DictWriter(fp, fieldnames=PREFETCH_COLUMNS)
+                w.writeheader()
+                w.writerows(rows)
+    notify(f"wrote {n_rows} matches for {len(queries)} queries")
+
+    if combined is not None:
+        combined_fp.close()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('database', help='sourmash database (zip, sbt.zip, ...) to search; queries are taken from it too')
+    p.add_argument('accessions', nargs='*', help='query accessions, matched to the first word of signature names')
+    p.add_argument('--from-file', help='file containing query accessions, one per line')
+    p.add_argument('-k', '--ksize', type=int, required=True)
+    p.add_argument('--dna', dest='moltype', action='store_const', const='DNA', default='DNA')
+    p.add_argument('--protein', dest='moltype', action='store_const', const='protein')
+    p.add_argument('--scaled', type=int, help='downsample all sketches to this scaled')
+    p.add_argument('--threshold-bp', type=int, default=50000, help='minimum estimated overlap (bp) to report a match')
+    p.add_argument('-o', '--output', help='write all matches to this (combined) prefetch csv; compressed if it ends in .gz or .zst')
+    p.add_argument('--outdir', help='write one prefetch csv per query to this directory')
+    p.add_argument('--suffix', default='.prefetch.csv', help='per-query csv file suffix for --outdir (e.g. .prefetch.csv.gz to compress)')
+    p.add_argument('--chunk-size', type=int, default=1000, help='number of database sketches to compare against the queries at a time')
+    args = p.parse_args()
+    if not (args.output or args.outdir):
+        p.error("one of -o/--output or --outdir is required")
+    sys.exit(main(args))
@@ -0,0 +1,218 @@
+
+# generate GTDB-like synthetic inputs for the benchmarks: taxonomy, prefetch csvs (nucleotide + protein) and linref csv
+import os
+import sys
+import csv
+import json
+import random
+import argparse
+
+RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+# mean number of children per taxon, from species (genomes per species) up to phylum (classes per phylum)
+BRANCHING = {"species": 3, "genus": 4, "family": 4, "order": 3, "class": 3, "phylum": 3}
+# (mean, sd) of ANI by LCA rank; AAI is higher for the same pair
+ANI_BY_RANK = {"species": (0.975, 0.012), "genus": (0.86, 0.03), "family": (0.79, 0.02),
+               "order": (0.77, 0.015), "class": (0.76, 0.01), "phylum": (0.75, 0.01), "superkingdom": (0.75, 0.01)}
+# how often a match shares each rank with the query (the rest share only the domain)
+MATCH_RANK_WEIGHTS = [("species", 0.3), ("genus", 0.3), ("family", 0.15), ("order", 0.1),
+                      ("class", 0.05), ("phylum", 0.05), ("superkingdom", 0.05)]
+
+# sourmash prefetch columns, with ANI named as read by prefetch-to-*.py (see batch-prefetch.py)
+PREFETCH_COLUMNS = ["intersect_bp", "jaccard", "max_containment", "f_query_match", "f_match_query",
+                    "match_filename", "match_name", "match_md5", "match_bp",
+                    "query_filename", "query_name", "query_md5", "query_bp",
+                    "ksize", "moltype", "scaled", "query_n_hashes", "query_ani", "match_ani"]
+
+
+def group(items, mean_size, rng):
+    "split items into consecutive groups of random size (mean ~mean_size)"
+    groups = []
+    start = 0
+    while start < len(items):
+        size = int(rng.expovariate(1 / mean_size)) + 1
+        groups.append(items[start:start + size])
+        start += size
+    return groups
+
+
+def make_lineages(n_genomes, rng):
+    """
+    GTDB-style lineage per genome, built bottom-up: genomes into species,
+    species into genera, ..., with the number of children per taxon varying
+    around BRANCHING. Returns (lineages, {rank: [genome lists]}).
+    """
+    taxa_at = {"species": group(list(range(n_genomes)), BRANCHING["species"], rng)}
+    for child, parent in zip(reversed(RANKS[2:]), reversed(RANKS[1:-1])):
+        taxa_at[parent] = [sum(children, []) for children in group(taxa_at[child], BRANCHING[child], rng)]
+    # two domains, ~1/10 of phyla archaeal
+    cut = max(1, len(taxa_at["phylum"]) // 10)
+    taxa_at["superkingdom"] = [sum(taxa_at["phylum"][cut:], []), sum(taxa_at["phylum"][:cut], [])]
+
+    lineages = [[] for _ in range(n_genomes)]
+    for rank in RANKS:
+        for n, members in enumerate(taxa_at[rank]):
+            if rank == "superkingdom":
+                name = ["d__Bacteria", "d__Archaea"][n]
+            elif rank == "species":
+                # GTDB species names are "Genus species"
+                name = f"s__{lineages[members[0]][-1][3:]} sp{n}"
+            else:
+                name = f"{rank[0]}__{rank.capitalize()}{n}"
+            for genome in members:
+                lineages[genome].append(name)
+    return lineages, taxa_at
+
+
+def make_idents(n_genomes, rng):
+    idents = []
+    for n in range(n_genomes):
+        prefix = "GCF" if rng.random() < 0.3 else "GCA"
+        idents.append(f"{prefix}_{rng.randrange(1, 10**9):09d}.{rng.choice([1, 1, 1, 2])}")
+    return idents
+
+
+def pick_match(query, genome_taxon, taxa_at, rng):
+    "pick a match genome sharing (at least) a randomly chosen rank with the query"
+    rank = rng.choices([r for r, _ in MATCH_RANK_WEIGHTS], [w for _, w in MATCH_RANK_WEIGHTS])[0]
+    members = taxa_at[rank][genome_taxon[rank][query]]
+    return rng.choice(members)
+
+
+def lca_rank(lin1, lin2):
+    shared = None
+    for rank, a, b in zip(RANKS, lin1, lin2):
+        if a != b:
+            break
+        shared = rank
+    return shared
+
+
+def prefetch_row(query, match, idents, names, sizes, lineages, ksize, scaled, moltype, aai, rng):
+    rank = lca_rank(lineages[query], lineages[match]) or "superkingdom"
+    mean, sd = ANI_BY_RANK[rank]
+    if aai:
+        mean = min(0.99, mean + 0.08)
+    query_ani = min(0.9999, max(0.5, rng.gauss(mean, sd)))
+    match_ani = min(0.9999, max(0.5, query_ani + rng.gauss(0, 0.003)))
+    f_match_query = query_ani ** ksize
+    f_query_match = match_ani ** ksize
+    intersect_bp = int(f_match_query * sizes[query])
+    query_hashes = sizes[query] // scaled
+    return {"intersect_bp": intersect_bp,
+            "jaccard": intersect_bp / max(1, sizes[query] + sizes[match] - intersect_bp),
+            "max_containment": max(f_match_query, f_query_match),
+            "f_query_match": f_query_match,
+            "f_match_query": f_match_query,
+            "match_filename": "gtdb-rs207.zip",
+            "match_name": names[match],
+            "match_md5": f"{rng.getrandbits(32):08x}",
+            "match_bp": sizes[match],
+            "query_filename": "gtdb-rs207.zip",
+            "query_name": names[query],
+            "query_md5": f"{rng.getrandbits(32):08x}",
+            "query_bp": sizes[query],
+            "ksize": ksize,
+            "moltype": moltype,
+            "scaled": scaled,
+            "query_n_hashes": query_hashes,
+            "query_ani": query_ani,
+            "match_ani": match_ani}
+
+
+def write_prefetch(outdir, label, genomes, n_matches, queries_per_file, ctx, ksize, scaled, moltype, aai, rng):
+    os.makedirs(os.path.join(outdir, label), exist_ok=True)
+    files = []
+    n_rows = 0
+    for start in range(0, len(genomes), queries_per_file):
+        batch = genomes[start:start + queries_per_file]
+        path = os.path.abspath(os.path.join(outdir, label, f"{ctx['idents'][batch[0]]}.prefetch.csv"))
+        with open(path, 'w', newline='') as fp:
+            w = csv.DictWriter(fp, fieldnames=PREFETCH_COLUMNS)
+            w.writeheader()
+            for query in batch:
+                matches = set()
+                for _ in range(n_matches):
+                    match = pick_match(query, ctx["genome_taxon"], ctx["taxa_at"], rng)
+                    if match != query:
+                        matches.add(match)
+                for match in sorted(matches):
+                    w.writerow(prefetch_row(query, match, ctx["idents"], ctx["names"], ctx["sizes"],
+                                            ctx["lineages"], ksize, scaled, moltype, aai, rng))
+                    n_rows += 1
+        files.append(path)
+    with open(os.path.join(outdir, f"{label}-files.txt"), 'w') as fp:
+        fp.write("\n".join(files) + "\n")
+    return n_rows
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    os.makedirs(args.outdir, exist_ok=True)
+    lineages, taxa_at = make_lineages(args.n_genomes, rng)
+    idents = make_idents(args.n_genomes, rng)
+    names = [f"{ident} {lineage[-1][3:]} strain {rng.randrange(1000)}" for ident, lineage in zip(idents, lineages)]
+    sizes = [rng.randrange(1500, 7000) * 1000 for _ in idents]
+    genome_taxon = dict((rank, {}) for rank in RANKS)
+    for rank in RANKS:
+        for n, members in enumerate(taxa_at[rank]):
+            for genome in members:
+                genome_taxon[rank][genome] = n
+
+    # taxonomy; a few genomes are missing, and some are listed under the other assembly prefix
+    n_tax = 0
+    with open(os.path.join(args.outdir, "taxonomy.csv"), 'w', newline='') as fp:
+        w = csv.writer(fp)
+        w.writerow(["ident"] + RANKS)
+        for ident, lineage in zip(idents, lineages):
+            if rng.random() < args.missing_fraction:
+                continue
+            if rng.random() < 0.05:
+                ident = ident.replace("GCA", "GCX").replace("GCF", "GCA").replace("GCX", "GCF")
+            w.writerow([ident] + lineage)
+            n_tax += 1
+
+    ctx = {"idents": idents, "names": names, "sizes": sizes, "lineages": lineages,
+           "taxa_at": taxa_at, "genome_taxon": genome_taxon}
+    genomes = list(range(args.n_genomes))
+    n_prefetch = write_prefetch(args.outdir, "prefetch", genomes, args.matches_per_query, args.queries_per_file,
+                                ctx, 31, 1000, "DNA", False, rng)
+    n_protein = write_prefetch(args.outdir, "protein-prefetch", genomes, args.matches_per_query, args.queries_per_file,
+                               ctx, 10, 200, "protein", True, rng)
+
+    # linref: integer genome ids; subjects are (mostly) genomes listed earlier, as in the real files
+    n_linref = 0
+    n_linref_genomes = int(args.n_genomes * args.linref_fraction)
+    with open(os.path.join(args.outdir, "linref.csv"), 'w', newline='') as fp:
+        w = csv.writer(fp)
+        w.writerow(["Genome_ID", "AssemblyID", "SubjectGenome", "ANI"])
+        for query in range(n_linref_genomes):
+            subjects = set()
+            for _ in range(args.linref_matches):
+                subject = pick_match(query, genome_taxon, taxa_at, rng)
+                if subject != query and subject < n_linref_genomes:
+                    subjects.add(subject)
+            for subject in sorted(subjects):
+                rank = lca_rank(lineages[query], lineages[subject]) or "superkingdom"
+                mean, sd = ANI_BY_RANK[rank]
+                w.writerow([f"g{query}", idents[query], f"g{subject}", round(min(1.0, rng.gauss(mean, sd)), 4)])
+                n_linref += 1
+
+    counts = {"genomes": args.n_genomes, "taxonomy_rows": n_tax, "prefetch_rows": n_prefetch,
+              "protein_prefetch_rows": n_protein, "linref_rows": n_linref}
+    with open(os.path.join(args.outdir, "counts.json"), 'w') as fp:
+        json.dump(counts, fp, indent=2)
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('-o', '--outdir', required=True)
+    p.add_argument('-n', '--n-genomes', type=int, default=2000)
+    p.add_argument('--matches-per-query', type=int, default=50)
+    p.add_argument('--queries-per-file', type=int, default=1, help='prefetch csvs per query genome (1, as in the pipeline) or batched')
+    p.add_argument('--linref-fraction', type=float, default=0.5, help='fraction of genomes with linref comparisons')
+    p.add_argument('--linref-matches', type=int, default=20)
+    p.add_argument('--missing-fraction', type=float, default=0.005, help='fraction of genomes left out of the taxonomy')
+    p.add_argument('--seed', type=int, default=1)
+    args = p.parse_args()
+    sys.exit(main(args))
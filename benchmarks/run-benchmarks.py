@@ -0,0 +1,145 @@
+
+# end-to-end benchmarks for the LCA-ANI scripts on synthetic data: wall time, rows/sec and peak RSS per step
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# make-synthetic-data.py settings per scale
+SCALES = {"tiny": {"n_genomes": 300, "matches_per_query": 30},
+          "small": {"n_genomes": 2000, "matches_per_query": 50},
+          "medium": {"n_genomes": 20000, "matches_per_query": 100},
+          "large": {"n_genomes": 100000, "matches_per_query": 200}}
+
+
+def steps(data, work):
+    "(name, command, input row count key) for each benchmarked step, in dependency order"
+    tax = os.path.join(data, "taxonomy.csv")
+    return [
+        ("prefetch-to-lca-sql", ["prefetch-to-lca-sql.py", "-t", tax, "-o", f"{work}/ani.sqldb",
+                                 "--from-file", f"{data}/prefetch-files.txt"], "prefetch_rows"),
+        ("prefetch-to-ani-csv", ["prefetch-to-ani-csv.py", "-t", tax, "-o", f"{work}/ani.csv",
+                                 "--from-file", f"{data}/prefetch-files.txt"], "prefetch_rows"),
+        ("prefetch-to-ani-csv-recalc", ["prefetch-to-ani-csv.py", "-t", tax, "-o", f"{work}/ani.r.csv", "-r",
+                                        "--from-file", f"{data}/prefetch-files.txt"], "prefetch_rows"),
+        ("prefetch-to-aai-csv", ["prefetch-to-ani-csv.py", "-t", tax, "-o", f"{work}/aai.csv",
+                                 "--from-file", f"{data}/protein-prefetch-files.txt"], "protein_prefetch_rows"),
+        ("linref-to-lca-csv", ["linref-to-lca-csv.py", f"{data}/linref.csv", "-t", tax,
+                               "-o", f"{work}/linref.lca.csv"], "linref_rows"),
+        ("combine-ani-csvs", ["combine-ani-csvs.py", "--ref-ani-csv", f"{work}/linref.lca.csv",
+                              "--sourmash-ani-csv", f"{work}/ani.csv", "-o", f"{work}/combined.csv"], "prefetch_rows"),
+        ("combine-ani-aai-csvs", ["combine-ani-aai-csvs.py", "--sourmash-ani-csv", f"{work}/ani.csv",
+                                  "--sourmash-aai-csv", f"{work}/aai.csv", "-o", f"{work}/combined-aai.csv"], "prefetch_rows"),
+        ("get-lca-ani", ["get-lca-ani.py", f"{work}/ani.sqldb", "-o", f"{work}/lca-ani.csv",
+                         "--lineage-csv", f"{work}/lineage-ani.csv"], "prefetch_rows"),
+    ]
+
+
+def run_step(cmd, log):
+    "run a script; returns (seconds, peak RSS in MB) of the child process"
+    start = time.perf_counter()
+    with open(log, 'w') as fp:
+        proc = subprocess.Popen([sys.executable] + cmd, cwd=REPO_DIR, stdout=fp, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f"{' '.join(cmd)} failed (exit {proc.returncode}); see {log}")
+    # ru_maxrss is in KiB on Linux
+    return seconds, rusage.ru_maxrss / 1024
+
+
+def make_data(data, scale, seed):
+    counts = os.path.join(data, "counts.json")
+    if not os.path.exists(counts):
+        settings = SCALES[scale]
+        subprocess.run([sys.executable, os.path.join(BENCH_DIR, "make-synthetic-data.py"), "-o", data,
+                        "-n", str(settings["n_genomes"]), "--matches-per-query", str(settings["matches_per_query"]),
+                        "--seed", str(seed)], check=True)
+    with open(counts) as fp:
+        return json.load(fp)
+
+
+def compare(results, baseline, tolerance):
+    "print results next to the baseline; return the names of steps slower than baseline * (1 + tolerance)"
+    regressions = []
+    print(f"{'step':<28}{'seconds':>10}{'rows/sec':>12}{'peak MB':>10}{'vs base':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratio = ""
+        if base:
+            r = result["seconds"] / base["seconds"]
+            ratio = f"{r:.2f}x"
+            if r > 1 + tolerance:
+                regressions.append(name)
+                ratio += " !"
+        print(f"{name:<28}{result['seconds']:>10.2f}{result['rows_per_sec']:>12.0f}{result['peak_rss_mb']:>10.0f}{ratio:>10}")
+    return regressions
+
+
+def main(args):
+    data = os.path.abspath(args.data_dir or os.path.join(BENCH_DIR, "data", args.scale))
+    work = os.path.abspath(args.work_dir or os.path.join(BENCH_DIR, "work", args.scale))
+    counts = make_data(data, args.scale, args.seed)
+    os.makedirs(work, exist_ok=True)
+
+    results = {}
+    for name, cmd, rows_key in steps(data, work):
+        if args.steps and name not in args.steps:
+            continue
+        runs = []
+        for _ in range(args.repeat):
+            # prefetch-to-lca-sql.py won't add to an existing db
+            if name == "prefetch-to-lca-sql" and os.path.exists(f"{work}/ani.sqldb"):
+                os.remove(f"{work}/ani.sqldb")
+            runs.append(run_step(cmd, os.path.join(work, f"{name}.log")))
+        # best of `repeat` runs: least affected by other load on the machine
+        seconds = min(s for s, _ in runs)
+        peak_rss = max(rss for _, rss in runs)
+        results[name] = {"seconds": seconds, "rows": counts[rows_key],
+                         "rows_per_sec": counts[rows_key] / seconds if seconds else 0.0,
+                         "peak_rss_mb": peak_rss}
+
+    with open(args.baseline) if os.path.exists(args.baseline) else open(os.devnull) as fp:
+        stored = json.loads(fp.read() or "{}")
+    regressions = compare(results, stored.get(args.scale, {}).get("steps", {}), args.tolerance)
+
+    if args.save_baseline:
+        stored[args.scale] = {"host": platform.node(), "python": platform.python_version(),
+                              "date": time.strftime("%Y-%m-%d"), "counts": counts, "steps": results}
+        with open(args.baseline, 'w') as fp:
+            json.dump(stored, fp, indent=2, sort_keys=True)
+        print(f"saved baseline for '{args.scale}' to {args.baseline}")
+    if args.metrics_json:
+        with open(args.metrics_json, 'w') as fp:
+            json.dump({"scale": args.scale, "counts": counts, "steps": results}, fp, indent=2)
+    if not args.keep_work:
+        shutil.rmtree(work)
+
+    if regressions:
+        print(f"slower than baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('--scale', default='small', choices=list(SCALES), help='size of the synthetic data set')
+    p.add_argument('--data-dir', help='synthetic data (generated here if missing); default benchmarks/data/<scale>')
+    p.add_argument('--work-dir', help='directory for outputs; default benchmarks/work/<scale>')
+    p.add_argument('--keep-work', action='store_true', help="don't delete outputs afterwards")
+    p.add_argument('--steps', nargs='*', help='only run these steps; earlier outputs they read must already be in the work dir (see --keep-work)')
+    p.add_argument('--repeat', type=int, default=1, help='runs per step; the fastest is reported')
+    p.add_argument('--baseline', default=os.path.join(BENCH_DIR, 'baseline.json'), help='stored baseline results')
+    p.add_argument('--save-baseline', action='store_true', help='store these results as the baseline for this scale')
+    p.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs baseline before failing')
+    p.add_argument('--metrics-json', help='also write these results to a json file')
+    p.add_argument('--seed', type=int, default=1)
+    args = p.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,134 @@
+
+# single-linkage genome clusters at several ANI thresholds, from an LCA-ANI database or csv/parquet table,
+# with each cluster's LCA and taxonomic purity
+import sys
+import csv
+import argparse
+import sqlite3
+import numpy as np
+from sourmash.lca import lca_utils
+from sourmash.logging import notify
+
+from ani_io import read_table_chunks, open_table
+from ani_utils import IdentIndex
+from ani_clusters import MultiUnionFind, cluster_taxonomy
+from anidb import readonly_uri
+from taxonomy_index import TaxonomyIndex, IdentResolver
+
+RANKS = list(lca_utils.taxlist(include_strain=False))
+
+
+def cluster_db(path, uf, chunk_size):
+    "stream (genome_id1, genome_id2, ani) from an LCA-ANI database; returns genome idents by id"
+    db = sqlite3.connect(readonly_uri(path), uri=True)
+    genomes = db.execute("SELECT genome_id, ident FROM genomes").fetchall()
+    idents = [None] * (max((genome_id for genome_id, _ in genomes), default=-1) + 1)
+    for genome_id, ident in genomes:
+        idents[genome_id] = ident
+    uf.grow(len(idents))
+    cursor = db.execute("SELECT genome_id1, genome_id2, ani FROM ani_comparisons")
+    n_rows = 0
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        ids = np.array(chunk, dtype=np.float64)
+        uf.add_edges(ids[:, 0].astype(np.int64), ids[:, 1].astype(np.int64), ids[:, 2])
+        n_rows += len(chunk)
+        notify(f"clustered {n_rows} comparisons")
+    db.close()
+    return idents
+
+
+def cluster_table(path, uf, resolver, ani_column, chunk_size):
+    "stream (query_name, match_name, ani) from a csv/parquet table; returns genome idents by id"
+    columns = ["query_name", "match_name", ani_column]
+    idents = IdentIndex()
+    n_rows = 0
+    for chunk in read_table_chunks(path, columns, chunk_size, dtype={"query_name": str, "match_name": str}):
+        ids1 = [idents.get_id(resolver.ident(name)) for name in chunk["query_name"]]
+        ids2 = [idents.get_id(resolver.ident(name)) for name in chunk["match_name"]]
+        uf.add_edges(ids1, ids2, chunk[ani_column].to_numpy(dtype=np.float64))
+        n_rows += len(chunk)
+        notify(f"clustered {n_rows} comparisons")
+    by_id = [None] * len(idents)
+    for ident, genome_id in idents.ids.items():
+        by_id[genome_id] = ident
+    return by_id
+
+
+def threshold_label(threshold):
+    return f"ani_{threshold * 100:g}"
+
+
+def main(args):
+    tax_index = TaxonomyIndex.load(args.taxonomy_csvs, cache=args.taxonomy_cache)
+    resolver = IdentResolver(tax_index)
+    uf = MultiUnionFind(args.thresholds)
+    if args.ani_db:
+        idents = cluster_db(args.ani_db, uf, args.chunk_size)
+    else:
+        idents = cluster_table(args.ani_csv, uf, resolver, args.ani_column, args.chunk_size)
+
+    # genome ids can have gaps (db ids of genomes since removed); those aren't clustered
+    present = np.array([ident is not None for ident in idents], dtype=bool)
+    tax_rows = np.array([resolver.resolve(ident)[1] if ident is not None else -1 for ident in idents], dtype=np.int64)
+    for ident in np.array(idents, dtype=object)[present & (tax_rows < 0)]:
+        tax_index.report_missing(ident)
+    all_labels = [np.unique(label[present], return_inverse=True)[1] for label in uf.labels(len(idents))]
+    genome_idents = np.array(idents, dtype=object)[present]
+    tax_rows = tax_rows[present]
+    purity_depth = RANKS.index(args.purity_rank) + 1
+
+    cluster_fields = ["threshold", "cluster", "size", "n_with_taxonomy", "lca_rank", "lca_lineage",
+                      "lca_genomes", "lca_completeness", f"{args.purity_rank}_purity", f"majority_{args.purity_rank}"]
+    with open_table(args.output, 'w') as fp:
+        w = csv.writer(fp)
+        w.writerow(cluster_fields)
+        for threshold, label in zip(uf.thresholds, all_labels):
+            info = cluster_taxonomy(tax_index, tax_rows, label, purity_depth)
+            n_clusters = len(info["size"])
+            rank_counts = {}
+            for n in range(n_clusters):
+                lca = tax_index.lineages[info["lca_row"][n]][:info["lca_depth"][n]] if info["lca_depth"][n] else ()
+                lca_rank = lca[-1].rank if lca else ""
+                rank_counts[lca_rank] = rank_counts.get(lca_rank, 0) + 1
+                majority = ""
+                if info["majority_row"][n] >= 0:
+                    majority = tax_index.lineages[info["majority_row"][n]][purity_depth - 1].name
+                # members without a lineage are not among the lca_genomes, so they are left out
+                completeness = info["n_taxonomy"][n] / info["lca_genomes"][n] if info["lca_genomes"][n] else ""
+                purity = "" if np.isnan(info["purity"][n]) else info["purity"][n]
+                w.writerow([threshold, n, info["size"][n], info["n_taxonomy"][n], lca_rank,
+                            lca_utils.display_lineage(lca) if lca else "", info["lca_genomes"][n],
+                            completeness, purity, majority])
+            n_singletons = int((info["size"] == 1).sum())
+            notify(f"ANI >= {threshold}: {n_clusters} clusters ({n_singletons} singletons) of {len(label)} genomes")
+            for rank in RANKS[::-1]:
+                if rank_counts.get(rank):
+                    notify(f"  LCA {rank}: {rank_counts[rank]} clusters")
+
+    if args.assignments:
+        # one row per genome: its cluster at each threshold
+        with open_table(args.assignments, 'w') as fp:
+            w = csv.writer(fp)
+            w.writerow(["ident"] + [threshold_label(t) for t in uf.thresholds])
+            for n, ident in enumerate(genome_idents):
+                w.writerow([ident] + [int(label[n]) for label in all_labels])
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument('--ani-db', help='LCA-ANI SQLite database (prefetch-to-lca-sql.py)')
+    src.add_argument('--ani-csv', help='LCA-ANI csv/parquet table (prefetch-to-ani-csv.py, linref-to-lca-csv.py)')
+    p.add_argument('--ani-column', default='avg_ani', help="ANI column to cluster on, for --ani-csv (e.g. 'ani' for linref tables)")
+    p.add_argument('--thresholds', nargs='+', type=float, default=[0.85, 0.90, 0.95], help='ANI thresholds (fractions) to cluster at')
+    p.add_argument('-t', '--taxonomy-csvs', nargs='+', required=True, help='taxonomy information')
+    p.add_argument('--taxonomy-cache', help='compiled taxonomy index; built from --taxonomy-csvs if missing or stale')
+    p.add_argument('--purity-rank', default='species', choices=RANKS, help='rank at which to measure cluster purity')
+    p.add_argument('-o', '--output', required=True, help='per-cluster csv: size, LCA, completeness + purity, for each threshold')
+    p.add_argument('--assignments', help='also write each genome\'s cluster at each threshold to this csv')
+    p.add_argument('--chunk-size', type=int, default=1000000, help='number of comparisons to read at a time')
+    args = p.parse_args()
+    sys.exit(main(args))
@@ -9,63 +9,52 @@ from sourmash.tax import tax_utils
 from sourmash.lca import lca_utils
 from sourmash.logging import notify
 
+from ani_utils import sorted_pair_rows, merge_join
+from ani_io import TableWriter, to_float
+from ani_stats import AccuracyReport
 
-def main(args):
-
-    # first read reference -->
-    comparisonD = {}
-    with open(args.ref_ani_csv, 'r') as pf:
-        ref_r = csv.DictReader(pf)
-        for n, row in enumerate(ref_r):
-            comp_name = row["comparison"]
-            row["ref_ani"] = row["ani"]
-            del row['ani']
-            # store in dict
-            comparisonD[comp_name] = row
-
-    # now read in sourmash ANI and match
-    with open(args.sourmash_ani_csv, 'r') as pf:
-        ani_r = csv.DictReader(pf)
-        for n, row in enumerate(ani_r):
-            if n % 10000 == 0:
-                notify(f"row {n}")
-            comp_name = row["comparison"]
-            query_name= row["query_name"]
-            query = tax_utils.get_ident(query_name)
-            match_name = row["match_name"]
-            match = tax_utils.get_ident(match_name)
-            rev_comp_name = f"{match}_{query}"
+RANKS = list(lca_utils.taxlist(include_strain=True))
 
-            # get dict entry and store
-            ref_entry = comparisonD.get(comp_name)
-            if ref_entry:
-                #fmh_ani = row["query_ani"]
-                #ref_entry["fmh_ani"] = fmh_ani
-                ref_entry["fmh_ani"] = row["avg_ani"]
-                comparisonD[comp_name] = ref_entry
-            else:
-                ref_entry = comparisonD.get(rev_comp_name)
-                if ref_entry:
-                    #fmh_ani = row["match_ani"]
-                    #ref_entry["fmh_ani"] = fmh_ani
-                    ref_entry["fmh_ani"] = row["avg_ani"]
-                    comparisonD[rev_comp_name] = ref_entry
 
-
-    with open(args.output_csv, 'w') as outF:
-        fields = ["comparison", "query_name", "match_name", "lca_rank", "lca_lineage", "ref_ani", "fmh_ani"]
-        writer = csv.DictWriter(outF, fieldnames=fields)
-        writer.writeheader()
-
-        for comp, compinfo in comparisonD.items():
-            if "fmh_ani" in compinfo.keys():
-                writer.writerow(compinfo)
+def main(args):
+    # both inputs are sorted on the (unordered) query/match pair with bounded
+    # memory, then joined in one streaming pass
+    ref_fields = ["comparison", "query_name", "match_name", "lca_rank", "lca_lineage", "ani"]
+    ref_rows = sorted_pair_rows(args.ref_ani_csv, ref_fields, args.sort_chunk_size, args.tmpdir)
+    fmh_rows = sorted_pair_rows(args.sourmash_ani_csv, ["avg_ani"], args.sort_chunk_size, args.tmpdir)
+
+    fields = ["comparison", "query_name", "match_name", "lca_rank", "lca_lineage", "ref_ani", "fmh_ani"]
+    # accuracy stats are accumulated during the join, a chunk of rows at a time
+    report = AccuracyReport() if args.accuracy_csv else None
+    chunk = []
+    writer = TableWriter(args.output_csv, fields) if args.output_csv else None
+    for ref_entry, fmh_entry in merge_join(ref_rows, fmh_rows):
+        row = ref_entry[3:] + fmh_entry[3:]
+        if writer is not None:
+            writer.writerow(row)
+        if report is not None:
+            chunk.append((row[3], to_float(row[5]), to_float(row[6])))
+            if len(chunk) >= 100000:
+                report.add(*zip(*chunk))
+                chunk = []
+    if writer is not None:
+        writer.close()
+    if report is not None:
+        if chunk:
+            report.add(*zip(*chunk))
+        report.write(args.accuracy_csv, RANKS)
+        report.notify_summary(RANKS)
 
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument('--ref-ani-csv', required=True, help = "LCA csv of reference ANI comparisons")
     p.add_argument('--sourmash-ani-csv', required=True, help= "LCA csv of sourmash comparisons")
-    p.add_argument('-o', '--output-csv', required=True, help='output csv')
+    p.add_argument('-o', '--output-csv', help='output csv')
+    p.add_argument('--accuracy-csv', help='also write bias/RMSE/correlation/error quantiles per LCA rank and ANI bin (see evaluate-ani-accuracy.py)')
+    p.add_argument('--sort-chunk-size', type=int, default=2000000, help='rows to sort in memory before spilling to disk')
+    p.add_argument('--tmpdir', help='directory for temporary sort files')
     args = p.parse_args()
+    if not (args.output_csv or args.accuracy_csv):
+        p.error("specify -o/--output-csv and/or --accuracy-csv")
     sys.exit(main(args))
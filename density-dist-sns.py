@@ -1,6 +1,7 @@
 import sys
 import argparse
 import csv
+import sqlite3
 import seaborn as sns
 import numpy as np
 import pandas as pd
@@ -9,8 +10,81 @@ import matplotlib.pyplot as plt
 from sourmash.logging import notify
 from collections import defaultdict
 
+from ani_io import is_parquet, read_table_chunks
+from ani_stats import AniStats, stats_by_sorted_group
+from anidb import readonly_uri
+from taxonomy_cache import read_cached, write_cached
+
 RANK_ORDER = ["species", "genus", "family", "order", "class", "phylum", "superkingdom"]
 
+def add_rank_chunk(rank_stats, ranks, anis, n_bins):
+    # add one chunk of (lca_rank, ani) values to the per-rank histograms
+    ranks = np.asarray(ranks)
+    anis = np.asarray(anis, dtype=np.float64)
+    for rank in np.unique(ranks):
+        if rank not in rank_stats:
+            rank_stats[rank] = AniStats(n_bins=n_bins)
+        rank_stats[rank].add(anis[ranks == rank])
+
+
+def rank_histograms_from_table(path, n_bins, chunk_size):
+    "one chunked pass over an LCA-ANI csv/parquet table: {lca_rank: AniStats} of avg_ani"
+    rank_stats = {}
+    n_rows = 0
+    for chunk in read_table_chunks(path, ['lca_rank', 'avg_ani'], chunk_size):
+        add_rank_chunk(rank_stats, chunk['lca_rank'].astype(str), chunk['avg_ani'], n_bins)
+        n_rows += len(chunk)
+        notify(f"binned {n_rows} rows")
+    return rank_stats
+
+
+def rank_histograms_from_db(path, n_bins):
+    "{lca_rank: AniStats} from an LCA-ANI sqlite database, in one pass over its (rank_id, ani) index"
+    db = sqlite3.connect(readonly_uri(path), uri=True)
+    cursor = db.execute("""SELECT r.rank, c.ani FROM ani_comparisons c
+                           JOIN ranks r ON r.rank_id = c.rank_id ORDER BY c.rank_id""")
+    rank_stats = dict((rank, stats) for (rank,), stats in stats_by_sorted_group(cursor, n_bins=n_bins))
+    db.close()
+    return rank_stats
+
+
+def load_rank_histograms(args):
+    # histograms for all ranks are cached, so the figure can be re-styled (or ranks changed) without rereading
+    source = args.ani_db or args.sourmash_ani_csv
+    if args.hist_cache:
+        rank_stats = read_cached(args.hist_cache, [source])
+        if rank_stats is not None and all(stats.n_bins == args.n_bins for stats in rank_stats.values()):
+            notify(f"loaded histograms from '{args.hist_cache}'")
+            return rank_stats
+    if args.ani_db:
+        rank_stats = rank_histograms_from_db(args.ani_db, args.n_bins)
+    else:
+        rank_stats = rank_histograms_from_table(args.sourmash_ani_csv, args.n_bins, args.chunk_size)
+    if args.hist_cache:
+        write_cached(args.hist_cache, [source], rank_stats)
+    return rank_stats
+
+
+def smoothed_density(stats):
+    """
+    Gaussian-smoothed density from a histogram, approximating sns.kdeplot:
+    Scott's-rule bandwidth (std * n^-1/5), evaluated out to 3 bandwidths
+    beyond the data range. Returns (x, density).
+    """
+    width = (stats.hi - stats.lo) / stats.n_bins
+    bw = stats.std * stats.n ** -0.2 if stats.n > 1 else 0.0
+    sigma = bw / width
+    pad = int(np.ceil(3 * sigma)) + 1
+    density = np.concatenate([np.zeros(pad), stats.hist / (stats.n * width), np.zeros(pad)])
+    x = stats.lo + (np.arange(-pad, stats.n_bins + pad) + 0.5) * width
+    if sigma > 0.5:
+        offsets = np.arange(-pad, pad + 1)
+        kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+        density = np.convolve(density, kernel / kernel.sum(), mode='same')
+    keep = (x >= stats.min - 3 * bw - width) & (x <= stats.max + 3 * bw + width)
+    return x[keep], density[keep]
+
+
 def main(args):
 
     # read values, generate LCA dictionary
@@ -25,23 +99,44 @@ def main(args):
     # colors, etc
     hex_colors = sns.color_palette("viridis", len(rank_order)).as_hex()
 
-    # read csv
-    ani_info = pd.read_csv(args.sourmash_ani_csv, usecols = ['lca_rank', 'lca_lineage','avg_ani']) # avg_ani
+    binned = args.binned or args.ani_db
+    if binned:
+        # streaming: fixed-resolution per-rank histograms instead of every point
+        rank_stats = load_rank_histograms(args)
+        rank_order = [rank for rank in rank_order if rank in rank_stats and rank_stats[rank].n]
+        hex_colors = sns.color_palette("viridis", len(rank_order)).as_hex()
+    else:
+        # read csv (or parquet: only the needed columns + row groups for the included ranks)
+        if is_parquet(args.sourmash_ani_csv):
+            ani_info = pd.read_parquet(args.sourmash_ani_csv, columns = ['lca_rank', 'lca_lineage','avg_ani'],
+                                       filters = [('lca_rank', 'in', rank_order)])
+        else:
+            ani_info = pd.read_csv(args.sourmash_ani_csv, usecols = ['lca_rank', 'lca_lineage','avg_ani']) # avg_ani
 
-    # subset to included ranks
-    ani_lca = ani_info[ani_info['lca_rank'].isin(rank_order)]
-    print(ani_lca['lca_rank'].unique())
+        # subset to included ranks
+        ani_lca = ani_info[ani_info['lca_rank'].isin(rank_order)]
+        print(ani_lca['lca_rank'].unique())
 
     # plot with seaborn
     plt.figure(figsize=(17,12))
     with sns.plotting_context("paper", font_scale=1.8,rc={"font.size":22,"axes.titlesize":22,"axes.labelsize":15}):
         sns.set_style("white")
-        #g = sns.kdeplot(data=ani_info, x="avg_ani", hue="lca_rank", fill=True, common_norm=False, palette="crest", alpha=.5, linewidth=2)
-        g = sns.kdeplot(data=ani_lca, x="avg_ani", hue="lca_rank", fill=True, common_norm=False, palette="viridis", alpha=.4, linewidth=2)
-        #lgd = plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
-        #plt.gcf().set_size_inches(17, 12)
+        if binned:
+            g = plt.gca()
+            for rank, color in zip(rank_order, hex_colors):
+                x, density = smoothed_density(rank_stats[rank])
+                g.fill_between(x, density, color=color, alpha=.4, linewidth=2, label=rank)
+                g.plot(x, density, color=color, linewidth=2)
+            g.set_ylabel("Density")
+            g.legend(title="lca_rank", loc="upper left", bbox_to_anchor=(1.05, 1))
+            sns.despine()
+        else:
+            #g = sns.kdeplot(data=ani_info, x="avg_ani", hue="lca_rank", fill=True, common_norm=False, palette="crest", alpha=.5, linewidth=2)
+            g = sns.kdeplot(data=ani_lca, x="avg_ani", hue="lca_rank", fill=True, common_norm=False, palette="viridis", alpha=.4, linewidth=2)
+            #lgd = plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+            #plt.gcf().set_size_inches(17, 12)
+            sns.move_legend(g, "upper left", bbox_to_anchor=(1.05, 1))#,frameon=False)
         plt.xlabel(f"Avg Containment {ani_label}", size=22)
-        sns.move_legend(g, "upper left", bbox_to_anchor=(1.05, 1))#,frameon=False)
         plt.tight_layout()
         plt.show()
 
@@ -57,10 +152,17 @@ def main(args):
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
-    p.add_argument('--sourmash-ani-csv', required=True, help= "LCA csv of sourmash comparisons with fmh_ani")
+    p.add_argument('--sourmash-ani-csv', help= "LCA csv (or .parquet) of sourmash comparisons with fmh_ani")
+    p.add_argument('--ani-db', help="LCA ANI sqlite database to plot instead of --sourmash-ani-csv (implies --binned)")
+    p.add_argument('--binned', action='store_true', help="stream the table into per-rank histograms and plot smoothed densities from those, instead of a KDE over every point")
+    p.add_argument('--n-bins', type=int, default=2000, help="number of ANI histogram bins over [0, 1] for --binned")
+    p.add_argument('--chunk-size', type=int, default=1000000, help="rows to read at a time for --binned")
+    p.add_argument('--hist-cache', help="cache file for --binned histograms; reused while the input file is unchanged")
     p.add_argument('--protein', action='store_true')
     p.add_argument('--include-ranks', nargs='*', default=RANK_ORDER, help="only consider certain LCA ranks")
     p.add_argument('--ksize', required=True)
     p.add_argument('--output-basename', required=True, default="gtdb-rs202")
     args = p.parse_args()
+    if not (args.sourmash_ani_csv or args.ani_db):
+        p.error("one of --sourmash-ani-csv or --ani-db is required")
     sys.exit(main(args))
@@ -0,0 +1,38 @@
+
+# accuracy of sketch (FracMinHash) ANI against reference ANI, from a joined table (combine-ani-csvs.py):
+# bias, MAE, RMSE, correlation and error quantiles per LCA rank and reference ANI bin, in one streaming pass
+import sys
+import argparse
+from sourmash.lca import lca_utils
+from sourmash.logging import notify
+
+from ani_io import read_table_chunks
+from ani_stats import AccuracyReport
+
+RANKS = list(lca_utils.taxlist(include_strain=True))
+
+
+def main(args):
+    report = AccuracyReport(bin_width=args.bin_width, n_bins=args.n_bins, error_range=args.error_range)
+    n_rows = 0
+    for chunk in read_table_chunks(args.joined_csv, ["lca_rank", args.ref_column, args.est_column], args.chunk_size):
+        report.add(chunk["lca_rank"].astype(str).to_numpy(), chunk[args.ref_column].to_numpy(dtype=float),
+                   chunk[args.est_column].to_numpy(dtype=float))
+        n_rows += len(chunk)
+        notify(f"evaluated {n_rows} rows")
+    report.write(args.output, RANKS)
+    report.notify_summary(RANKS)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('joined_csv', help='joined reference + sketch ANI table (combine-ani-csvs.py output; csv or parquet)')
+    p.add_argument('-o', '--output', required=True, help='summary csv: one row per LCA rank x reference ANI bin, plus per-rank, per-bin and overall rows')
+    p.add_argument('--ref-column', default='ref_ani', help='reference ANI column')
+    p.add_argument('--est-column', default='fmh_ani', help='estimated (sketch) ANI column')
+    p.add_argument('--bin-width', type=float, default=0.01, help='width of the reference ANI bins')
+    p.add_argument('--error-range', type=float, default=0.2, help='error quantiles are resolved within +/- this range')
+    p.add_argument('--n-bins', type=int, default=2000, help='number of error histogram bins (quantile resolution is 2 * error-range / n-bins)')
+    p.add_argument('--chunk-size', type=int, default=1000000, help='number of rows to read at a time')
+    args = p.parse_args()
+    sys.exit(main(args))
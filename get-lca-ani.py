@@ -1,4 +1,3 @@
-
 # fetch from lca ANI table
 import sys
 import argparse
@@ -9,39 +8,72 @@ from sourmash.tax import tax_utils
 from sourmash.lca import lca_utils
 from sourmash.logging import notify
 
+from anidb import has_table, STAT_COLUMNS
+from ani_io import open_table
+from ani_stats import AniStats, QUANTILE_NAMES, stats_by_sorted_group
+
+# n, min, avg, max, std, quantiles -- the summary table columns without the running sums
+REPORT_COLUMNS = STAT_COLUMNS[:-2]
+
 
-def get_lca_ani_stats(db_cursor, lca_name):
-    db_cursor.execute(''' SELECT MIN(ani), AVG(ani), MAX(ani)
-                          FROM comparisons WHERE lca_name=?
-                      ''', (lca_name,))
-    min, avg, max = db_cursor.fetchall()[0]
-    return min, avg, max
+def read_summaries(db):
+    # precomputed summary tables: {rank: stats}, [(rank, lca_name, stats)]
+    columns = ", ".join(f"s.{col}" for col in REPORT_COLUMNS)
+    rank_stats = {}
+    for rank, *stats in db.execute(f''' SELECT r.rank, {columns}
+                                        FROM rank_summary s JOIN ranks r ON r.rank_id = s.rank_id'''):
+        rank_stats[rank] = stats
+    lineage_stats = db.execute(f''' SELECT r.rank, l.name, {columns}
+                                    FROM lineage_summary s
+                                    JOIN lineages l ON l.lineage_id = s.lineage_id
+                                    JOIN ranks r ON r.rank_id = l.rank_id
+                                    ORDER BY l.rank_id, l.name''')
+    lineage_stats = [(rank, name, stats) for rank, name, *stats in lineage_stats]
+    return rank_stats, lineage_stats
 
-def get_rank_ani_stats(db_cursor, lca_rank):
-    db_cursor.execute(''' SELECT MIN(ani), AVG(ani), MAX(ani)
-                          FROM comparisons WHERE lca_rank=?
-                      ''', (lca_rank,))
-    min,avg,max = db_cursor.fetchall()[0]
-    return min, avg, max
+def summarize_comparisons(db, n_bins=1000):
+    # databases without summary tables: one sorted pass over `comparisons`,
+    # per-lineage stats merged up into per-rank stats
+    cursor = db.execute("SELECT lca_rank, lca_name, ani FROM comparisons ORDER BY lca_rank, lca_name")
+    rank_stats = {}
+    lineage_stats = []
+    for (rank, name), stats in stats_by_sorted_group(cursor, n_bins=n_bins):
+        lineage_stats.append((rank, name, stats.summary()))
+        if rank not in rank_stats:
+            rank_stats[rank] = AniStats(n_bins=n_bins)
+        rank_stats[rank].merge(stats)
+    rank_stats = dict((rank, stats.summary()) for rank, stats in rank_stats.items())
+    # same order as the summary tables: by rank (superkingdom first), then name
+    rank_order = dict((rank, n) for n, rank in enumerate(lca_utils.taxlist(include_strain=True)))
+    lineage_stats.sort(key=lambda x: (rank_order.get(x[0], len(rank_order)), x[1]))
+    return rank_stats, lineage_stats
 
 
 def main(args):
     # load sqlite table
     db = sqlite3.connect(args.anidb)
-    c = db.cursor()
-    notify("rank:    minANI | avgANI | maxANI")
+    # shards (--no-summaries) have the summary tables, but empty
+    if has_table(db, 'rank_summary') and db.execute("SELECT 1 FROM rank_summary LIMIT 1").fetchone() is not None:
+        rank_stats, lineage_stats = read_summaries(db)
+    else:
+        notify("no summary tables in database; computing stats from comparisons")
+        rank_stats, lineage_stats = summarize_comparisons(db, n_bins=args.n_bins)
+
+    notify("rank:    minANI | avgANI | maxANI | medianANI | n")
     notify("---------------------------------")
-    header = ['rank', 'minANI', 'avgANI', 'maxANI']
+    quantile_header = [f"{q}ANI" for q in QUANTILE_NAMES]
+    header = ['rank', 'minANI', 'avgANI', 'maxANI', 'nComparisons', 'stdANI'] + quantile_header
 
     outF= None
     if args.output_csv:
-        outF = open(args.output_csv, 'w')
+        outF = open_table(args.output_csv, 'w')
         outF.write(','.join(header) + "\n")
 
+    empty = [0] + [None] * (len(REPORT_COLUMNS) - 1)
     for rank in lca_utils.taxlist(include_strain=False):
-        ani_min, ani_avg, ani_max = get_rank_ani_stats(c, rank)
-        info = [ani_min, ani_avg, ani_max]
-        notify(f"{rank}: {ani_min} | {ani_avg} | {ani_max}")
+        n, ani_min, ani_avg, ani_max, ani_std, *quantiles = rank_stats.get(rank, empty)
+        info = [ani_min, ani_avg, ani_max, n, ani_std] + quantiles
+        notify(f"{rank}: {ani_min} | {ani_avg} | {ani_max} | {quantiles[2]} | {n}")
         # replace None with ""
         info = ["" if x is None else str(x) for x in info]
         if outF is not None:
@@ -50,11 +82,21 @@ def main(args):
     if outF is not None:
         outF.close()
 
+    if args.lineage_csv:
+        with open_table(args.lineage_csv, 'w') as lineageF:
+            w = csv.writer(lineageF)
+            w.writerow(['rank', 'lca_name', 'minANI', 'avgANI', 'maxANI', 'nComparisons', 'stdANI'] + quantile_header)
+            for rank, name, (n, ani_min, ani_avg, ani_max, ani_std, *quantiles) in lineage_stats:
+                info = [ani_min, ani_avg, ani_max, n, ani_std] + quantiles
+                w.writerow([rank, name] + ["" if x is None else x for x in info])
+
 
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument('anidb', help='ANI SQLite database')
     p.add_argument('-o', '--output-csv', required=True, help='CSV output')
+    p.add_argument('--lineage-csv', help='also write per-lineage ANI stats to this CSV')
+    p.add_argument('--n-bins', type=int, default=1000, help='histogram bins over [0, 1] for quantiles (databases without summary tables)')
     args = p.parse_args()
     sys.exit(main(args))
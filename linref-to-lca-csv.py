@@ -6,43 +6,19 @@ import sqlite3
 import csv
 import numpy as np
 from sourmash.tax import tax_utils
-from sourmash.lca import lca_utils
 from sourmash.logging import notify
 
+from ani_utils import IdentIndex, PairSet, pair_keys
+from ani_io import TableWriter, open_table
+from taxonomy_index import TaxonomyIndex, IdentResolver
+from metrics import metrics, add_metrics_args
 
-def get_lineage(ident, tax_assign):
-    try:
-        lineage = tax_assign[ident]
-    except KeyError:
-        if "GCF" in ident:
-            ident = ident.replace("GCF", "GCA")
-        elif "GCA" in ident:
-            ident = ident.replace("GCA", "GCF")
-        #print("new ident: ", ident)
-        # ARGH, having 202 --> 207 lineage matching issues. just let it be None and notify
-        lineage = tax_assign.get(ident, None)
-    return lineage
-
-def lineages_lca(linA, linB):
-    for rank in tax_utils.ascending_taxlist():
-        if lca_utils.is_lineage_match(linA, linB, rank):
-            lca = lca_utils.pop_to_rank(linA, rank)
-            return lca
-
-def get_lca(id1, id2, lineages):
-    lin1 = get_lineage(id1, lineages)
-    lin2 = get_lineage(id2, lineages)
-    if lin1 is None or lin2 is None:
-        if lin1 is None:
-            notify(f"{id1} is not in taxonomy files")
-        if lin2 is None:
-            notify(f"{id2} is not in taxonomy files")
-        return None
-    return lineages_lca(lin1,lin2)
 
 def main(args):
+    metrics.start(args)
     # load in taxonomy
-    tax_assign = tax_utils.MultiLineageDB.load(args.taxonomy_csvs, keep_identifier_versions=False)
+    with metrics.stage("load taxonomy"):
+        tax_index = TaxonomyIndex.load(args.taxonomy_csvs, cache=args.taxonomy_cache)
 
 
     # handle file input
@@ -52,27 +28,28 @@ def main(args):
         linref_csvs += ff_csvs
 
     gid_to_acc = {}
+    # AssemblyID --> accession without version, parsed once per assembly
+    accessions = IdentResolver(parse=lambda acc: acc.rsplit('.')[0])
     # read in each file and load into table
-    with open(args.output_csv, 'w') as outF:
-        fields = ["comparison", "query_name", "match_name", "lca_rank", "lca_lineage", "ani"]
-        writer = csv.writer(outF)
-        writer.writerow(fields)
-
-        comparisons = set()
+    fields = ["comparison", "query_name", "match_name", "lca_rank", "lca_lineage", "ani"]
+    with TableWriter(args.output_csv, fields) as writer:
+        comparisons = PairSet()
+        idents = IdentIndex()
         missing_ids = set()
         n_missing_comparisons = 0
         n_missing_lin = 0
         for inF in linref_csvs:
-            with open(inF, 'r') as pf:
+            candidates = []
+            n_read = 0
+            with metrics.stage("read csv"), open_table(inF) as pf:
                 linref_r = csv.DictReader(pf)
                 for n, row in enumerate(linref_r):
                     if n % 10000 == 0:
                         notify(f"row {n+1}")
+                    n_read += 1
                     query_id = row["Genome_ID"]
-                    query_acc = row["AssemblyID"]
-
                     # drop version num
-                    query_acc = query_acc.rsplit('.')[0]
+                    query_acc = accessions.ident(row["AssemblyID"])
                     # add query info to gid_to_acc
                     gid_to_acc[query_id] = query_acc
 
@@ -83,25 +60,35 @@ def main(args):
                     except KeyError:
                         missing_ids.add(subject_id)
                         n_missing_comparisons +=1
+                        metrics.count("rows_missing_subject")
                         continue # skip this entry
 
+                    candidates.append((query_acc, subject_acc, row["ANI"]))
+            metrics.count("files_read")
+            metrics.count("rows_read", n_read)
+
+            # avoid dupes
+            with metrics.stage("dedup"):
+                is_new = comparisons.add_new(pair_keys(idents, ((q, s) for q, s, _ in candidates)))
+            metrics.count("rows_duplicate", len(candidates) - int(is_new.sum()))
+            candidates = [c for c, new in zip(candidates, is_new) if new]
+            with metrics.stage("lca"):
+                lcas = tax_index.get_lcas([(q, s) for q, s, _ in candidates])
+            with metrics.stage("write"):
+                n_written = 0
+                for (query_acc, subject_acc, ani), lca_lin in zip(candidates, lcas):
                     comparison_name = f"{query_acc}_x_{subject_acc}"
-                    reverse_name = f"{subject_acc}_x_{query_acc}"
-
-                    if any([comparison_name in comparisons, reverse_name in comparisons]):
-                        # avoid dupes
-                        continue
-                    comparisons.add(comparison_name)
 
-                    lca_lin = get_lca(query_acc, subject_acc, tax_assign)
                     if lca_lin is None:
                         # if missing lineage, can't get LCA. Skip.
                         n_missing_lin +=1
+                        metrics.count("rows_missing_lineage")
                         continue
-                    ani = row["ANI"]
 
                     # write csv
                     writer.writerow([comparison_name, query_acc, subject_acc, lca_lin[-1].rank, lca_lin[-1].name, ani])
+                    n_written += 1
+            metrics.count("rows_written", n_written)
 
             print(f"missed {len(missing_ids)} ids, which resulted in {n_missing_comparisons} skipped comparisons")
             print(f"could not find LCA for {n_missing_lin} comparisons")
@@ -114,6 +101,8 @@ if __name__ == "__main__":
     p.add_argument('linref_csvs', nargs='*')
     p.add_argument('--from-file', '--linref-from-file', help="file containing paths to linref csvs")
     p.add_argument('-t', '--taxonomy-csvs', nargs='+', help='taxonomy information', required=True)
+    p.add_argument('--taxonomy-cache', help='compiled taxonomy index; built from --taxonomy-csvs if missing or stale')
     p.add_argument('-o', '--output-csv', required=True, help='output csv')
+    add_metrics_args(p)
     args = p.parse_args()
     sys.exit(main(args))
@@ -0,0 +1,54 @@
+
+# merge LCA ANI databases (e.g. shards built by prefetch-to-lca-sql.py) into one
+import sys
+import argparse
+import sqlite3
+from sourmash.logging import notify
+
+from ani_utils import PairSet
+from metrics import metrics, add_metrics_args
+from anidb import set_bulk_pragmas, create_schema, count_comparisons, AniDBWriter, load_genome_idents, copy_shard, DEFAULT_TOP_K
+
+
+def main(args):
+    metrics.start(args)
+    db = sqlite3.connect(args.output)
+    n_existing = count_comparisons(db)
+    if n_existing:
+        notify(f"ERROR: '{args.output}' already holds {n_existing} comparisons")
+        return 1
+    set_bulk_pragmas(db, journal_mode=args.journal_mode, cache_mb=args.cache_mb)
+    create_schema(db)
+
+    shard_dbs = args.shard_dbs
+    if args.from_file:
+        shard_dbs += [x.strip() for x in open(args.from_file, 'r')]
+
+    # comparisons are deduplicated across shards, first shard wins
+    idents = load_genome_idents(db)
+    comparisons = PairSet()
+    writer = AniDBWriter(db, idents, batch_size=args.batch_size, top_k=args.top_k)
+    for shard_db in shard_dbs:
+        notify(f"merging '{shard_db}'")
+        with metrics.stage("copy shard"):
+            copy_shard(writer, comparisons, shard_db)
+        metrics.count("shards_read")
+
+    # build indexes + summaries over the merged table
+    writer.finish()
+    db.execute("PRAGMA journal_mode=DELETE")
+    db.close()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('shard_dbs', nargs='*', help='LCA ANI SQLite databases to merge, in order')
+    p.add_argument('--from-file', help="file containing paths to databases to merge")
+    p.add_argument('-o', '--output', required=True, help='merged SQLite database')
+    p.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='store this many nearest neighbors per genome (0: none)')
+    p.add_argument('--batch-size', type=int, default=1000000, help='number of rows to insert + commit at a time')
+    p.add_argument('--journal-mode', default='wal', choices=['wal', 'off', 'delete', 'memory'], help='SQLite journal mode to use while loading')
+    p.add_argument('--cache-mb', type=int, default=512, help='SQLite page cache size (MB) to use while loading')
+    add_metrics_args(p)
+    args = p.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,161 @@
+# stage timing, counters and memory sampling for the ingestion scripts (--profile / --metrics-json)
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sourmash.logging import notify
+
+
+def current_rss_mb():
+    "resident set size of this process, in MB"
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # no /proc (e.g. macOS): fall back to the peak so far (bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    maxrss = resource.getrusage(who).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 1024
+
+
+class Metrics:
+    """
+    Per-stage wall time and named counters for one run.
+
+    Stages nest freely and are timed with `with metrics.stage(name)`; the
+    same stage can be entered many times (e.g. once per file) and is
+    accumulated. Pool workers record into their own copy, hand it back with
+    take(), and the parent merge()s it, so worker stage times are summed
+    over processes and can exceed the run's wall time.
+
+    Recording is always on (it is per-file, not per-row, so cheap); start()
+    adds RSS sampling and the report at exit.
+    """
+    def __init__(self):
+        self.stages = defaultdict(lambda: [0.0, 0])
+        self.counters = defaultdict(int)
+        self.rss_samples = []
+        self.peak_rss = 0.0
+        self.start_time = time.perf_counter()
+        self.script = None
+        self.profile = False
+        self.metrics_json = None
+        self._sampler = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages[name]
+            stage[0] += time.perf_counter() - start
+            stage[1] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def take(self):
+        "return and reset the stages + counters recorded so far (in a pool worker)"
+        snapshot = {"stages": dict(self.stages), "counters": dict(self.counters)}
+        self.stages.clear()
+        self.counters.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, (seconds, calls) in snapshot["stages"].items():
+            stage = self.stages[name]
+            stage[0] += seconds
+            stage[1] += calls
+        for name, n in snapshot["counters"].items():
+            self.counters[name] += n
+
+    def _sample_rss(self, interval, stop):
+        while not stop.wait(interval):
+            rss = current_rss_mb()
+            self.peak_rss = max(self.peak_rss, rss)
+            self.rss_samples.append((round(time.perf_counter() - self.start_time, 2), round(rss, 1)))
+            # keep the series short for long runs: drop every other sample, sample half as often
+            if len(self.rss_samples) >= 1000:
+                del self.rss_samples[1::2]
+                interval *= 2
+
+    def start(self, args, script=None):
+        "start RSS sampling + report at exit, if --profile or --metrics-json was given"
+        self.profile = getattr(args, "profile", False)
+        self.metrics_json = getattr(args, "metrics_json", None)
+        if not (self.profile or self.metrics_json):
+            return
+        self.script = script or os.path.basename(sys.argv[0])
+        self.start_time = time.perf_counter()
+        stop = threading.Event()
+        self._sampler = (threading.Thread(target=self._sample_rss, args=(args.rss_interval, stop), daemon=True), stop)
+        self._sampler[0].start()
+        atexit.register(self.finish)
+
+    def report(self):
+        wall = time.perf_counter() - self.start_time
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rates = dict((f"{name}_per_sec", self.counters[name] / wall)
+                     for name in ("rows_read", "rows_written") if name in self.counters and wall > 0)
+        return {"script": self.script,
+                "argv": sys.argv[1:],
+                "wall_seconds": wall,
+                "cpu_seconds": usage.ru_utime + usage.ru_stime,
+                "children_cpu_seconds": children.ru_utime + children.ru_stime,
+                "peak_rss_mb": max(self.peak_rss, peak_rss_mb()),
+                # largest single child process (e.g. a pool worker), once it has exited
+                "peak_children_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+                "stages": dict((name, {"seconds": seconds, "calls": calls})
+                               for name, (seconds, calls) in self.stages.items()),
+                "counters": dict(self.counters),
+                "rates": rates,
+                "rss_samples": self.rss_samples}
+
+    def finish(self):
+        if self._sampler is None:
+            return
+        thread, stop = self._sampler
+        stop.set()
+        thread.join()
+        self._sampler = None
+        report = self.report()
+        if self.metrics_json:
+            with open(self.metrics_json, 'w') as fp:
+                json.dump(report, fp, indent=2)
+        if self.profile:
+            notify(f"{self.script}: {report['wall_seconds']:.1f}s wall, {report['cpu_seconds']:.1f}s cpu "
+                   f"(+{report['children_cpu_seconds']:.1f}s in workers), peak RSS {report['peak_rss_mb']:.0f} MB "
+                   f"(workers {report['peak_children_rss_mb']:.0f} MB)")
+            for name, stage in sorted(report["stages"].items(), key=lambda x: -x[1]["seconds"]):
+                notify(f"  {name:<24}{stage['seconds']:>10.2f}s{stage['calls']:>10} calls")
+            for name, n in sorted(report["counters"].items()):
+                notify(f"  {name:<24}{n:>12}")
+
+
+# per-process instance, as for worker_context: forked pool workers start from the parent's copy
+metrics = Metrics()
+
+
+def gather(results):
+    "yield results from a pool map of (result, metrics.take()) pairs, merging the workers' metrics"
+    for result, snapshot in results:
+        metrics.merge(snapshot)
+        yield result
+
+
+def add_metrics_args(p):
+    p.add_argument('--profile', action='store_true', help='print per-stage timings, counters and peak memory at exit')
+    p.add_argument('--metrics-json', help='write per-stage timings, counters and memory samples to this json file at exit')
+    p.add_argument('--rss-interval', type=float, default=1.0, help='seconds between memory samples for --profile/--metrics-json')
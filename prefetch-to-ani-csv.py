@@ -8,44 +8,97 @@ import numpy as np
 from sourmash.tax import tax_utils
 from sourmash.lca import lca_utils
 from sourmash.logging import notify
-from sourmash.distance_utils import containment_to_distance
-
-
-def get_lineage(ident, tax_assign):
-    try:
-        lineage = tax_assign[ident]
-    except KeyError:
-        if "GCF" in ident:
-            ident = ident.replace("GCF", "GCA")
-        elif "GCA" in ident:
-            ident = ident.replace("GCA", "GCF")
-        #print("new ident: ", ident)
-        # ARGH, having 202 --> 207 lineage matching issues. just let it be None and notify
-        lineage = tax_assign.get(ident, None)
-    return lineage
-
-def lineages_lca(linA, linB):
-    for rank in tax_utils.ascending_taxlist():
-        if lca_utils.is_lineage_match(linA, linB, rank):
-            lca = lca_utils.pop_to_rank(linA, rank)
-            return lca
-
-def get_lca(id1, id2, lineages):
-    lin1 = get_lineage(id1, lineages)
-    lin2 = get_lineage(id2, lineages)
-    if lin1 is None or lin2 is None:
-        if lin1 is None:
-            notify(f"{id1} is not in taxonomy files")
-        if lin2 is None:
-            notify(f"{id2} is not in taxonomy files")
-        return None
-    return lineages_lca(lin1,lin2)
+
+from ani_utils import imap_bounded, filter_seen, worker_context, IdentIndex, PairSet, pair_keys, containment_to_ani
+from ani_io import TableWriter, open_table
+from taxonomy_index import TaxonomyIndex, LcaFilter, IdentResolver
+from metrics import metrics, gather, add_metrics_args
+
 
 #def get_avg_contanment_ani(query_bp, ):
 
+def load_prefetch_csv(inF, tax_index, resolver, comparisons, idents, lca_filter, recalculate_ani=False):
+    # read one prefetch csv; skip comparisons already in the PairSet `comparisons` (either orientation).
+    # returns (query_id, match_id, info) rows; info is None if LCA can't be found or the row is filtered out
+    with metrics.stage("read csv"):
+        with open_table(inF) as pf:
+            prefetch_rows = list(csv.DictReader(pf))
+    metrics.count("files_read")
+    metrics.count("rows_read", len(prefetch_rows))
+    with metrics.stage("get_ident"):
+        ids = resolver.ident_pairs([row['query_name'] for row in prefetch_rows], [row['match_name'] for row in prefetch_rows])
+    # avoid dupes
+    with metrics.stage("dedup"):
+        is_new = comparisons.add_new(pair_keys(idents, ids))
+        new_rows = [(row, pair) for row, pair, new in zip(prefetch_rows, ids, is_new) if new]
+    metrics.count("rows_duplicate", len(prefetch_rows) - len(new_rows))
+
+    # cheapest filter first: do the lineages share the highest allowed rank (taxon ids only)?
+    rows = []
+    with metrics.stage("rank filter"):
+        maybe = lca_filter.maybe_keep(tax_index, [pair for _, pair in new_rows])
+    rows += [(query_id, match_id, None) for (_, (query_id, match_id)), keep in zip(new_rows, maybe) if not keep]
+    candidates = [x for x, keep in zip(new_rows, maybe) if keep]
+
+    # containment / ANI math for the whole file at once
+    with metrics.stage("ani"):
+        q_containment = np.array([float(row['f_match_query']) for row, _ in candidates])
+        m_containment = np.array([float(row['f_query_match']) for row, _ in candidates])
+        # depending on version of prefetch, might not have avg contain -- recalc here.
+        avg_containment = (q_containment + m_containment) / 2
+
+        if recalculate_ani:
+            ksize = [int(row['ksize']) for row, _ in candidates]
+            scaled = [int(row['scaled']) for row, _ in candidates]
+            n_unique_kmers = [int(row['query_bp']) for row, _ in candidates]
+            # don't let any ANI values get zeroed out --> estimate independtly
+            query_ani = containment_to_ani(q_containment, ksize, scaled, n_unique_kmers)
+            match_ani = containment_to_ani(m_containment, ksize, scaled, n_unique_kmers)
+            avg_ani = (query_ani + match_ani) / 2
+            query_ani, match_ani = query_ani.tolist(), match_ani.tolist()
+        else:
+            query_ani = [row['query_ani'] for row, _ in candidates]
+            match_ani = [row['match_ani'] for row, _ in candidates]
+            avg_ani = (np.array(query_ani, dtype=np.float64) + np.array(match_ani, dtype=np.float64)) / 2
+
+        # then ANI, then the full LCA
+        keep = lca_filter.keep_ani(avg_ani)
+    with metrics.stage("lca"):
+        passed = np.flatnonzero(keep)
+        lcas = [None] * len(candidates)
+        for n, lca_lin in zip(passed, tax_index.get_lcas([candidates[n][1] for n in passed])):
+            lcas[n] = lca_lin
+    n_missing = sum(1 for n in passed if lcas[n] is None)
+    metrics.count("rows_missing_lineage", n_missing)
+
+    found = 0
+    for n, ((row, (query_id, match_id)), lca_lin) in enumerate(zip(candidates, lcas)):
+        if not lca_filter.keep_lca(lca_lin):
+            rows.append((query_id, match_id, None))
+            continue
+        if found % 10000 == 0:
+            notify(f"row {found}")
+        found += 1
+        comparison_name = f"{query_id}_x_{match_id}"
+        rows.append((query_id, match_id,
+                     [comparison_name, query_id, match_id, lca_lin[-1].rank, lca_lin[-1].name, query_ani[n], match_ani[n],
+                      float(avg_ani[n]), float(q_containment[n]), float(m_containment[n]), float(avg_containment[n])]))
+    metrics.count("rows_filtered", len(new_rows) - n_missing - found)
+    return rows
+
+def load_prefetch_csv_worker(inF):
+    rows = load_prefetch_csv(inF, worker_context["tax_index"], worker_context["resolver"], PairSet(), IdentIndex(),
+                             worker_context["lca_filter"], worker_context["recalculate_ani"])
+    return rows, metrics.take()
+
 def main(args):
+    metrics.start(args)
     # load in taxonomy
-    tax_assign = tax_utils.MultiLineageDB.load(args.taxonomy_csvs, keep_identifier_versions=False)
+    with metrics.stage("load taxonomy"):
+        tax_index = TaxonomyIndex.load(args.taxonomy_csvs, cache=args.taxonomy_cache)
+    # genome name --> ident, parsed once per distinct name (per worker, with -p)
+    resolver = IdentResolver(tax_index)
+    lca_filter = LcaFilter(include_ranks=args.include_ranks, max_lca_rank=args.max_lca_rank, min_ani=args.min_ani)
 
     # handle file input
     prefetch_csvs = args.prefetch_csvs
@@ -54,62 +107,33 @@ def main(args):
         prefetch_csvs += ff_csvs
 
     # read in each file and load into table
-    with open(args.output_csv, 'w') as outF:
-        fields = ["comparison", "query_name", "match_name", "lca_rank",
-                  "lca_lineage", "query_ani", "match_ani", "avg_ani",
-                  "query_containment", "match_containment", "avg_containment"]
-
-        writer = csv.writer(outF)
-        writer.writerow(fields)
-
-        comparisons = set()
-        for inF in prefetch_csvs:
-            with open(inF, 'r') as pf:
-                prefetch_r = csv.DictReader(pf)
-                for n, row in enumerate(prefetch_r):
-                    if n % 10000 == 0:
-                        notify(f"row {n}")
-                    query_name = row['query_name']
-                    query_id = tax_utils.get_ident(query_name)
-                    match_name = row['match_name']
-                    match_id = tax_utils.get_ident(match_name)
-
-                    comparison_name = f"{query_id}_x_{match_id}"
-                    reverse_name = f"{match_id}_x_{query_id}"
-
-                    if any([comparison_name in comparisons, reverse_name in comparisons]):
-                        # avoid dupes
+    fields = ["comparison", "query_name", "match_name", "lca_rank",
+              "lca_lineage", "query_ani", "match_ani", "avg_ani",
+              "query_containment", "match_containment", "avg_containment"]
+
+    with TableWriter(args.output_csv, fields) as writer:
+        comparisons = PairSet()
+        idents = IdentIndex()
+        if args.processes > 1:
+            # workers dedup within each file; dedup across files happens here, in file order
+            results = gather(imap_bounded(load_prefetch_csv_worker, prefetch_csvs, args.processes,
+                                          context={"tax_index": tax_index, "resolver": resolver, "lca_filter": lca_filter,
+                                                   "recalculate_ani": args.recalculate_ani}))
+            results = (filter_seen(rows, comparisons, idents) for rows in results)
+        else:
+            results = (load_prefetch_csv(inF, tax_index, resolver, comparisons, idents, lca_filter, args.recalculate_ani) for inF in prefetch_csvs)
+
+        for rows in results:
+            with metrics.stage("write"):
+                n_written = 0
+                for query_id, match_id, info in rows:
+                    if info is None:
+                        # if missing lineage, can't get LCA (or filtered out). Skip.
                         continue
-                    comparisons.add(comparison_name)
-
-                    lca_lin = get_lca(query_id, match_id, tax_assign)
-                    if lca_lin is None:
-                        # if missing lineage, can't get LCA. Skip.
-                        continue
-                    q_containment = float(row['f_match_query'])
-                    m_containment = float(row['f_query_match'])
-                    # depending on version of prefetch, might not have avg contain -- recalc here.
-                    avg_containment = np.mean([q_containment, m_containment])
-
-                    if args.recalculate_ani:
-                        ksize = int(row['ksize'])
-                        scaled = int(row['scaled'])
-                        n_unique_kmers = int(row['query_bp'])
-                        query_dist = containment_to_distance(q_containment, ksize, scaled, n_unique_kmers=n_unique_kmers).dist
-                        match_dist = containment_to_distance(m_containment, ksize, scaled, n_unique_kmers=n_unique_kmers).dist
-                        # don't let any ANI values get zeroed out --> estimate independtly
-                        query_ani = 1-query_dist
-                        match_ani = 1-match_dist
-                    else:
-
-                        query_ani = row['query_ani']
-                        match_ani = row['match_ani']
-
-                    avg_ani = np.mean([float(query_ani), float(match_ani)])
-
                     # write csv
-                    writer.writerow([comparison_name, query_id, match_id, lca_lin[-1].rank, lca_lin[-1].name, query_ani, match_ani, avg_ani, q_containment, m_containment, avg_containment])
-
+                    writer.writerow(info)
+                    n_written += 1
+            metrics.count("rows_written", n_written)
 
 
 if __name__ == "__main__":
@@ -117,7 +141,13 @@ if __name__ == "__main__":
     p.add_argument('prefetch_csvs', nargs='*')
     p.add_argument('--from-file', '--prefetch-from-file', help="file containing paths to prefetch csvs")
     p.add_argument('-t', '--taxonomy-csvs', nargs='+', help='taxonomy information', required=True)
+    p.add_argument('--taxonomy-cache', help='compiled taxonomy index; built from --taxonomy-csvs if missing or stale')
     p.add_argument('-o', '--output-csv', required=True, help='output csv')
     p.add_argument('-r', '--recalculate-ani', action='store_true')
+    p.add_argument('--include-ranks', nargs='*', help='only write comparisons whose LCA is at one of these ranks')
+    p.add_argument('--max-lca-rank', choices=list(lca_utils.taxlist(include_strain=True)), help='only write comparisons whose LCA is at this rank or below (e.g. genus: genus, species, strain)')
+    p.add_argument('--min-ani', type=float, help='only write comparisons with at least this avg_ani')
+    p.add_argument('-p', '--processes', type=int, default=1, help='number of processes to use for reading prefetch csvs')
+    add_metrics_args(p)
     args = p.parse_args()
     sys.exit(main(args))
@@ -3,62 +3,117 @@
 import sys
 import argparse
 import sqlite3
-import csv
+import hashlib
 import numpy as np
 from sourmash.tax import tax_utils
 from sourmash.lca import lca_utils
 from sourmash.logging import notify
 
-
-def get_lineage(name, tax_assign):
-    ident = tax_utils.get_ident(name) #, keep_identifier_versions=True)
-    try:
-        lineage = tax_assign[ident]
-    except KeyError:
-        if "GCF" in ident:
-            ident = ident.replace("GCF", "GCA")
-        elif "GCA" in ident:
-            ident = ident.replace("GCA", "GCF")
-        #print("new ident: ", ident)
-        # ARGH, having 202 --> 207 lineage matching issues. just let it be None and notify
-        lineage = tax_assign.get(ident, None)
-    return lineage
-
-def lineages_lca(linA, linB):
-    for rank in tax_utils.ascending_taxlist():
-        if lca_utils.is_lineage_match(linA, linB, rank):
-            lca = lca_utils.pop_to_rank(linA, rank)
-            return lca
-
-def get_lca(name1, name2, lineages):
-    lin1 = get_lineage(name1, lineages)
-    lin2 = get_lineage(name2, lineages)
-    if lin1 is None or lin2 is None:
-        if lin1 is None:
-            notify(f"{name1} is not in taxonomy files")
-        if lin2 is None:
-            notify(f"{name2} is not in taxonomy files")
-        return None
-    return lineages_lca(lin1,lin2)
-
-def anisql_insert(db_cursor, info_tuple):
-    names = ('ident1', 'ident2', 'lca_rank', 'lca_name', 'ani')
-    assert len(info_tuple) == len(names)
-    db_cursor.execute('INSERT INTO comparisons (ident1, ident2, lca_rank, lca_name, ani) VALUES (?, ?, ?, ?, ?)',
-               info_tuple)
+from ani_utils import imap_bounded, filter_seen, worker_context, IdentIndex, PairSet, pair_keys, pair_sort_key
+from ani_io import read_csv_columns
+from taxonomy_index import TaxonomyIndex, LcaFilter, IdentResolver
+from metrics import metrics, gather, add_metrics_args
+from anidb import (set_bulk_pragmas, create_schema, count_comparisons, AniDBWriter, plan_prefetch_files, finish_rescan,
+                   load_genome_idents, load_existing_pairs, DEFAULT_TOP_K)
+
+# the prefetch csv columns used; the rest are never read
+PREFETCH_COLUMNS = ["query_name", "match_name", "query_ani", "match_ani"]
+
+
+def load_prefetch_chunk(chunk, tax_index, resolver, comparisons, idents, lca_filter, only_pairs=None):
+    # run one chunk of prefetch rows (a list per PREFETCH_COLUMNS column) through dedup, filters and LCA;
+    # see load_prefetch_csv. returns (queries, rows)
+    query_names, match_names, query_anis, match_anis = chunk
+    metrics.count("rows_read", len(query_names))
+    with metrics.stage("get_ident"):
+        ids = resolver.ident_pairs(query_names, match_names)
+    queries = set(query for query, _ in ids)
+    wanted = range(len(ids))
+    if only_pairs is not None:
+        # re-reading an unchanged file: the rest of its comparisons are already in the db
+        wanted = [n for n, pair in enumerate(ids) if pair_sort_key(*pair) in only_pairs]
+        metrics.count("rows_unchanged", len(ids) - len(wanted))
+    # avoid dupes
+    with metrics.stage("dedup"):
+        is_new = comparisons.add_new(pair_keys(idents, [ids[n] for n in wanted]))
+        new_rows = [n for n, new in zip(wanted, is_new) if new]
+    metrics.count("rows_duplicate", len(wanted) - len(new_rows))
+
+    # cheapest filters first: shared rank (taxon ids only), then ANI, then the full LCA
+    with metrics.stage("rank filter"):
+        keep = lca_filter.maybe_keep(tax_index, [ids[n] for n in new_rows])
+    with metrics.stage("ani"):
+        anis = np.zeros(len(new_rows))
+        candidates = np.flatnonzero(keep)
+        if len(candidates):
+            query_ani = np.array([float(query_anis[new_rows[n]]) for n in candidates])
+            match_ani = np.array([float(match_anis[new_rows[n]]) for n in candidates])
+            anis[candidates] = (query_ani + match_ani) / 2
+            keep[candidates] = lca_filter.keep_ani(anis[candidates])
+    with metrics.stage("lca"):
+        passed = np.flatnonzero(keep)
+        lcas = [None] * len(new_rows)
+        for n, lca_lin in zip(passed, tax_index.get_lcas([ids[new_rows[n]] for n in passed])):
+            lcas[n] = lca_lin
+    n_missing = sum(1 for n in passed if lcas[n] is None)
+    metrics.count("rows_missing_lineage", n_missing)
+
+    rows = []
+    for n, (row, lca_lin) in enumerate(zip(new_rows, lcas)):
+        query_id, match_id = ids[row]
+        if not lca_filter.keep_lca(lca_lin):
+            rows.append((query_id, match_id, None))
+            continue
+
+        rows.append((query_id, match_id, (query_id, query_names[row], match_id, match_names[row], lca_lin[-1].rank, lca_lin[-1].name, anis[n])))
+    metrics.count("rows_filtered", len(new_rows) - n_missing - sum(1 for _, _, info in rows if info is not None))
+    return queries, rows
+
+def load_prefetch_csv(inF, tax_index, resolver, comparisons, idents, lca_filter, only_pairs=None, chunk_size=1000000):
+    # read one prefetch csv, chunk_size rows of the four columns used at a time;
+    # skip comparisons already in the PairSet `comparisons` (either orientation),
+    # and if `only_pairs` is given, any whose pair_sort_key isn't in it.
+    # returns (md5, queries, rows): the file's md5 and query genome idents for the manifest, and
+    # (query_id, match_id, info) rows; info is None if LCA can't be found or the row is filtered out.
+    # the manifest md5 is of the file as stored, taken while it streams in
+    md5 = hashlib.md5()
+    chunks = read_csv_columns(inF, PREFETCH_COLUMNS, chunk_size, digest=md5)
+    queries, rows = set(), []
+    while True:
+        with metrics.stage("read csv"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        chunk_queries, chunk_rows = load_prefetch_chunk(chunk, tax_index, resolver, comparisons, idents, lca_filter, only_pairs)
+        queries.update(chunk_queries)
+        rows += chunk_rows
+    metrics.count("files_read")
+    return md5.hexdigest(), sorted(queries), rows
+
+def load_prefetch_csv_worker(item):
+    inF, rescan = item
+    only_pairs = worker_context["removed_pairs"] if rescan else None
+    result = load_prefetch_csv(inF, worker_context["tax_index"], worker_context["resolver"], PairSet(), IdentIndex(),
+                               worker_context["lca_filter"], only_pairs, worker_context["chunk_size"])
+    return result, metrics.take()
 
 def main(args):
+    metrics.start(args)
     # set up sqlite table
     db = sqlite3.connect(args.output)
-    c = db.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS comparisons (ident1 TEXT NOT NULL,
-                                           ident2 TEXT NOT NULL,
-                                           lca_rank TEXT NOT NULL,
-                                           lca_name TEXT NOT NULL,
-                                           ani FLOAT NOT NULL) ''')
+    n_existing = count_comparisons(db)
+    if n_existing and not args.incremental:
+        notify(f"ERROR: '{args.output}' already holds {n_existing} comparisons; use --incremental to add to it")
+        return 1
+    set_bulk_pragmas(db, journal_mode=args.journal_mode, cache_mb=args.cache_mb)
+    create_schema(db)
 
     # load in taxonomy
-    tax_assign = tax_utils.MultiLineageDB.load(args.taxonomy_csvs, keep_identifier_versions=False)
+    with metrics.stage("load taxonomy"):
+        tax_index = TaxonomyIndex.load(args.taxonomy_csvs, cache=args.taxonomy_cache)
+    # genome name --> ident, parsed once per distinct name (per worker, with -p)
+    resolver = IdentResolver(tax_index)
+    lca_filter = LcaFilter(include_ranks=args.include_ranks, max_lca_rank=args.max_lca_rank, min_ani=args.min_ani)
 
     # handle file input
     prefetch_csvs = args.prefetch_csvs
@@ -66,37 +121,53 @@ def main(args):
         ff_csvs = [x.strip() for x in open(args.from_file, 'r')]
         prefetch_csvs += ff_csvs
 
-    # read in each file and load into table
-    comparisons = set()
-    for inF in prefetch_csvs:
-        with open(inF, 'r') as pf:
-            prefetch_r = csv.DictReader(pf)
-            for n, row in enumerate(prefetch_r):
-                if n % 50000 == 0:
-                    notify(f"read {n} rows")
-                query_name = row['query_name']
-                match_name = row['match_name']
-                query_id = tax_utils.get_ident(query_name)
-                match_id = tax_utils.get_ident(match_name)
-
-                comparison_name = f"{query_id}_x_{match_id}"
-                reverse_name = f"{match_id}_x_{query_id}"
-
-                if any([comparison_name in comparisons, reverse_name in comparisons]):
-                    # avoid dupes
-                    continue
-                comparisons.add(comparison_name)
+    # skip files already loaded (by path, size and md5); drop old rows of changed files,
+    # and re-read unchanged files for any of those comparisons they hold
+    with metrics.stage("plan files"):
+        to_load, removed_pairs = plan_prefetch_files(db, prefetch_csvs)
 
-                lca_lin = get_lca(query_name, match_name, tax_assign)
-                if lca_lin is None:
-                    # if missing lineage, can't get LCA. Skip.
-                    continue
+    # dedup against the comparisons already in the db, using their genome ids
+    idents = load_genome_idents(db)
+    comparisons = PairSet()
+    if n_existing:
+        with metrics.stage("load existing pairs"):
+            load_existing_pairs(db, comparisons)
 
-                ani = np.mean([float(row['query_ani']), float(row['match_ani'])])
-                anisql_insert(c, (query_name, match_name, lca_lin[-1].rank, lca_lin[-1].name, ani))
-
-    # commit table
-    db.commit()
+    # read in each file and load into table
+    if args.processes > 1:
+        # workers dedup within each file; dedup across files happens here, in file order
+        results = gather(imap_bounded(load_prefetch_csv_worker, [(pf.path, pf.rescan) for pf in to_load], args.processes,
+                                      context={"tax_index": tax_index, "resolver": resolver, "lca_filter": lca_filter,
+                                               "removed_pairs": removed_pairs, "chunk_size": args.chunk_size}))
+        results = ((md5, queries, filter_seen(rows, comparisons, idents)) for md5, queries, rows in results)
+    else:
+        results = (load_prefetch_csv(pf.path, tax_index, resolver, comparisons, idents, lca_filter,
+                                     removed_pairs if pf.rescan else None, args.chunk_size) for pf in to_load)
+
+    writer = AniDBWriter(db, idents, batch_size=args.batch_size, top_k=args.top_k)
+    for prefetch_file, (md5, queries, rows) in zip(to_load, results):
+        n_comparisons = 0
+        with metrics.stage("write"):
+            for query_id, match_id, info in rows:
+                if info is None:
+                    # if missing lineage, can't get LCA (or filtered out). Skip.
+                    continue
+                writer.add(*info, file_id=prefetch_file.file_id)
+                n_comparisons += 1
+        prefetch_file.md5 = md5
+        writer.add_file(prefetch_file, prefetch_file.n_loaded + n_comparisons, queries)
+    writer.flush()
+    finish_rescan(db)
+
+    if args.no_summaries:
+        # e.g. a shard that will be merged with merge-ani-sqldbs.py
+        writer.flush()
+    else:
+        # write + commit any remaining rows; build indexes + summaries
+        writer.finish()
+    # don't leave the db in WAL mode -- readers may not have write access for the -wal/-shm files
+    db.execute("PRAGMA journal_mode=DELETE")
+    db.close()
 
 
 if __name__ == "__main__":
@@ -104,6 +175,19 @@ if __name__ == "__main__":
     p.add_argument('prefetch_csvs', nargs='*')
     p.add_argument('--from-file', '--prefetch-from-file', help="file containing paths to prefetch csvs")
     p.add_argument('-t', '--taxonomy-csvs', nargs='+', required=True, help='taxonomy information')
+    p.add_argument('--taxonomy-cache', help='compiled taxonomy index; built from --taxonomy-csvs if missing or stale')
     p.add_argument('-o', '--output', required=True, help='SQLite database')
+    p.add_argument('--include-ranks', nargs='*', help='only store comparisons whose LCA is at one of these ranks')
+    p.add_argument('--max-lca-rank', choices=list(lca_utils.taxlist(include_strain=True)), help='only store comparisons whose LCA is at this rank or below (e.g. genus: genus, species, strain)')
+    p.add_argument('--min-ani', type=float, help='only store comparisons with at least this (average) ANI')
+    p.add_argument('--incremental', action='store_true', help='add to an existing database, loading only new or changed prefetch csvs')
+    p.add_argument('--no-summaries', action='store_true', help="don't build indexes or summary tables (for shards that will be merged)")
+    p.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='store this many nearest neighbors per genome (0: none)')
+    p.add_argument('--batch-size', type=int, default=100000, help='number of rows to insert + commit at a time')
+    p.add_argument('--journal-mode', default='wal', choices=['wal', 'off', 'delete', 'memory'], help='SQLite journal mode to use while loading')
+    p.add_argument('--chunk-size', type=int, default=1000000, help='number of prefetch csv rows to read + process at a time')
+    p.add_argument('-p', '--processes', type=int, default=1, help='number of processes to use for reading prefetch csvs')
+    p.add_argument('--cache-mb', type=int, default=512, help='SQLite page cache size (MB) to use while loading')
+    add_metrics_args(p)
     args = p.parse_args()
     sys.exit(main(args))
@@ -0,0 +1,94 @@
+# inverted hash --> sketch index for many-vs-all containment over FracMinHash sketches
+import numpy as np
+from scipy import sparse
+from sourmash.logging import notify
+
+
+def sketch_hashes(minhash):
+    return np.unique(np.fromiter(minhash.hashes, dtype=np.uint64, count=len(minhash)))
+
+
+class SketchIndex:
+    """
+    Inverted index over a collection of scaled sketches, built once and
+    queried many times.
+
+    Every distinct hash gets a column id; `inverted` is a sparse
+    (hash x sketch) 0/1 matrix, so the overlaps of a batch of queries with
+    every sketch are one sparse product rather than a scan of the collection.
+    Sketches are downsampled to a common `scaled` as they are added.
+    """
+    def __init__(self, scaled=None):
+        self.scaled = scaled
+        self.ksize = None
+        self.moltype = None
+        self.names = []
+        self.filenames = []
+        self.md5s = []
+        self.dataset_bp = []
+        self._hashes = []
+        self.sizes = None
+        self.hash_values = None
+        self.inverted = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def downsample(self, minhash):
+        if self.scaled is None:
+            self.scaled = minhash.scaled
+        if minhash.scaled > self.scaled:
+            raise ValueError(f"sketch scaled={minhash.scaled} is coarser than index scaled={self.scaled}")
+        if minhash.scaled < self.scaled:
+            minhash = minhash.downsample(scaled=self.scaled)
+        return minhash
+
+    def add(self, sig, filename=None):
+        "add a signature; returns its sketch index"
+        mh = self.downsample(sig.minhash)
+        if self.ksize is None:
+            self.ksize, self.moltype = mh.ksize, mh.moltype
+        elif (mh.ksize, mh.moltype) != (self.ksize, self.moltype):
+            raise ValueError(f"'{sig.name}' is {mh.moltype} k={mh.ksize}; index is {self.moltype} k={self.ksize}")
+        self.names.append(sig.name)
+        self.filenames.append(sig.filename or filename)
+        self.md5s.append(sig.md5sum())
+        # estimated genome size, from the sketch as given (before downsampling)
+        self.dataset_bp.append(sig.minhash.unique_dataset_hashes)
+        self._hashes.append(sketch_hashes(mh))
+        return len(self.names) - 1
+
+    def build(self):
+        self.sizes = np.array([len(h) for h in self._hashes], dtype=np.int64)
+        self.dataset_bp = np.array(self.dataset_bp, dtype=np.int64)
+        all_hashes = np.concatenate(self._hashes) if self._hashes else np.zeros(0, dtype=np.uint64)
+        self._hashes = None
+        owners = np.repeat(np.arange(len(self.sizes), dtype=np.int32), self.sizes)
+        self.hash_values, columns = np.unique(all_hashes, return_inverse=True)
+        del all_hashes
+        self.inverted = sparse.csr_matrix((np.ones(len(owners), dtype=np.int32), (columns, owners)),
+                                          shape=(len(self.hash_values), len(self.sizes)))
+        notify(f"indexed {len(self.hash_values)} distinct hashes from {len(self.sizes)} sketches")
+
+    def sketch_matrix(self):
+        "sparse (sketch x hash column) matrix -- a transposed copy of `inverted`"
+        return self.inverted.T.tocsr()
+
+    def query_matrix(self, hash_arrays):
+        "sparse (query x hash column) matrix for a list of hash arrays; hashes not in the index are dropped"
+        rows, cols = [], []
+        for n, hashes in enumerate(hash_arrays):
+            idx = np.searchsorted(self.hash_values, hashes)
+            found = idx < len(self.hash_values)
+            found[found] = self.hash_values[idx[found]] == hashes[found]
+            idx = idx[found]
+            cols.append(idx)
+            rows.append(np.full(len(idx), n, dtype=np.int64))
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                 shape=(len(hash_arrays), len(self.hash_values)))
+
+    def overlaps(self, hash_arrays):
+        "sparse (query x sketch) matrix of the number of shared hashes"
+        return (self.query_matrix(hash_arrays) @ self.inverted).tocsr()
@@ -0,0 +1,137 @@
+
+# build LCA ANI table directly from sourmash sketches (all-vs-all), without prefetch csvs
+import sys
+import argparse
+import sqlite3
+import numpy as np
+import sourmash
+from sourmash.logging import notify
+
+from ani_utils import imap_bounded, init_worker, worker_context, containment_to_ani
+from taxonomy_index import TaxonomyIndex, IdentResolver
+from sketch_index import SketchIndex
+from metrics import metrics, gather, add_metrics_args
+from anidb import set_bulk_pragmas, create_schema, count_comparisons, AniDBWriter, load_genome_idents, DEFAULT_TOP_K
+
+
+def load_sketches(sketch_files, ksize, moltype, scaled=None):
+    index = SketchIndex(scaled=scaled)
+    for filename in sketch_files:
+        for sig in sourmash.load_file_as_signatures(filename, ksize=ksize, select_moltype=moltype):
+            index.add(sig, filename=filename)
+            if len(index) % 10000 == 0:
+                notify(f"loaded {len(index)} sketches")
+    index.build()
+    return index
+
+
+def compare_block(block):
+    """
+    Compare sketches [start, stop) against all later sketches, via the sparse
+    product of their rows of the sketch x hash matrix with the inverted index.
+    Returns (i, j, lca depth, ani) arrays for pairs i < j that pass
+    threshold_bp and share at least one rank.
+    """
+    start, stop = block
+    index = worker_context["index"]
+    tax_rows = worker_context["tax_rows"]
+    with metrics.stage("overlaps"):
+        counts = (worker_context["matrix"][start:stop] @ index.inverted).tocoo()
+    i = counts.row.astype(np.int64) + start
+    j = counts.col.astype(np.int64)
+    intersect = counts.data.astype(np.int64)
+    keep = (j > i) & (intersect * index.scaled >= worker_context["threshold_bp"]) & \
+           (tax_rows[i] >= 0) & (tax_rows[j] >= 0)
+    i, j, intersect = i[keep], j[keep], intersect[keep]
+    order = np.lexsort((j, i))
+    i, j, intersect = i[order], j[order], intersect[order]
+
+    with metrics.stage("lca"):
+        depths = worker_context["tax_index"].lca_depths(tax_rows[i], tax_rows[j])
+    found = depths > 0
+    i, j, intersect, depths = i[found], j[found], intersect[found], depths[found]
+    # ani as in prefetch-to-lca-sql.py: mean of the ANI estimated from each containment
+    with metrics.stage("ani"):
+        ani_i = containment_to_ani(intersect / index.sizes[i], index.ksize, index.scaled, index.dataset_bp[i])
+        ani_j = containment_to_ani(intersect / index.sizes[j], index.ksize, index.scaled, index.dataset_bp[j])
+    metrics.count("pairs_compared", len(i))
+    return i, j, depths, (ani_i + ani_j) / 2
+
+
+def compare_block_worker(block):
+    return compare_block(block), metrics.take()
+
+
+def main(args):
+    metrics.start(args)
+    db = sqlite3.connect(args.output)
+    n_existing = count_comparisons(db)
+    if n_existing:
+        notify(f"ERROR: '{args.output}' already holds {n_existing} comparisons")
+        return 1
+    set_bulk_pragmas(db, journal_mode=args.journal_mode, cache_mb=args.cache_mb)
+    create_schema(db)
+
+    with metrics.stage("load taxonomy"):
+        tax_index = TaxonomyIndex.load(args.taxonomy_csvs, cache=args.taxonomy_cache)
+
+    sketch_files = args.sketches
+    if args.from_file:
+        sketch_files += [x.strip() for x in open(args.from_file, 'r')]
+    with metrics.stage("load sketches"):
+        index = load_sketches(sketch_files, args.ksize, args.moltype, args.scaled)
+    metrics.count("sketches_read", len(index))
+
+    # lineage row per sketch; sketches without one are reported once and never compared
+    resolver = IdentResolver(tax_index)
+    idents = [resolver.ident(name) for name in index.names]
+    tax_rows = np.array([resolver.resolve(name)[1] for name in index.names], dtype=np.int64)
+    for ident in np.array(idents, dtype=object)[tax_rows < 0]:
+        tax_index.report_missing(ident)
+    metrics.count("sketches_missing_lineage", int((tax_rows < 0).sum()))
+
+    # each unordered pair is produced once (i < j), so no dedup is needed
+    context = {"index": index, "matrix": index.sketch_matrix(), "tax_index": tax_index,
+               "tax_rows": tax_rows, "threshold_bp": args.threshold_bp}
+    blocks = [(start, min(start + args.block_size, len(index))) for start in range(0, len(index), args.block_size)]
+    if args.processes > 1:
+        results = gather(imap_bounded(compare_block_worker, blocks, args.processes, context=context))
+    else:
+        init_worker(context)
+        results = map(compare_block, blocks)
+
+    writer = AniDBWriter(db, load_genome_idents(db), batch_size=args.batch_size, top_k=args.top_k)
+    for (start, stop), (i, j, depths, anis) in zip(blocks, results):
+        with metrics.stage("write"):
+            for n1, n2, depth, ani in zip(i.tolist(), j.tolist(), depths.tolist(), anis.tolist()):
+                lca = tax_index.lineages[tax_rows[n1]][depth - 1]
+                writer.add(idents[n1], index.names[n1], idents[n2], index.names[n2], lca.rank, lca.name, ani)
+        notify(f"compared sketches {start}-{stop} of {len(index)}")
+
+    # write + commit any remaining rows; build indexes + summaries
+    writer.finish()
+    db.execute("PRAGMA journal_mode=DELETE")
+    db.close()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('sketches', nargs='*', help='sourmash signature files / databases to compare all-vs-all')
+    p.add_argument('--from-file', help="file containing paths to signature files")
+    p.add_argument('-k', '--ksize', type=int, required=True)
+    p.add_argument('--dna', dest='moltype', action='store_const', const='DNA', default='DNA')
+    p.add_argument('--protein', dest='moltype', action='store_const', const='protein')
+    p.add_argument('--scaled', type=int, help='downsample all sketches to this scaled')
+    p.add_argument('--threshold-bp', type=int, default=50000, help='minimum estimated overlap (bp) for a comparison to be kept')
+    p.add_argument('-t', '--taxonomy-csvs', nargs='+', required=True, help='taxonomy information')
+    p.add_argument('--taxonomy-cache', help='compiled taxonomy index; built from --taxonomy-csvs if missing or stale')
+    p.add_argument('-o', '--output', required=True, help='SQLite database')
+    p.add_argument('--block-size', type=int, default=1000, help='number of sketches to compare against the rest at a time')
+    p.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='store this many nearest neighbors per genome (0: none)')
+    p.add_argument('--batch-size', type=int, default=100000, help='number of rows to insert + commit at a time')
+    p.add_argument('--journal-mode', default='wal', choices=['wal', 'off', 'delete', 'memory'], help='SQLite journal mode to use while loading')
+    p.add_argument('--cache-mb', type=int, default=512, help='SQLite page cache size (MB) to use while loading')
+    p.add_argument('-p', '--processes', type=int, default=1, help='number of processes to use for comparing blocks of sketches')
+    add_metrics_args(p)
+    args = p.parse_args()
+    sys.exit(main(args))
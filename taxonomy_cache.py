@@ -0,0 +1,54 @@
+# pickled caches keyed on the files they were built from, and the taxonomy ident list.
+# stdlib only (plus ani_io), so the snakefile can use it at parse time without loading numpy or sourmash
+import os
+import csv
+import pickle
+
+from ani_io import open_table
+
+
+# bump when the pickled TaxonomyIndex layout changes
+CACHE_VERSION = 1
+
+
+def source_signature(taxonomy_csvs):
+    "identify a set of taxonomy files by path, size and mtime"
+    sig = []
+    for path in taxonomy_csvs:
+        st = os.stat(path)
+        sig.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
+    return (CACHE_VERSION, tuple(sig))
+
+
+def read_cached(cache, taxonomy_csvs):
+    "return the object pickled in `cache`, or None if missing or stale"
+    try:
+        with open(cache, 'rb') as fp:
+            signature = pickle.load(fp)
+            if signature != source_signature(taxonomy_csvs):
+                return None
+            return pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def write_cached(cache, taxonomy_csvs, obj):
+    # write + rename, so concurrent jobs never read a partial cache
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as fp:
+        pickle.dump(source_signature(taxonomy_csvs), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache)
+
+
+def load_taxonomy_idents(taxonomy_csv, cache=None):
+    "list of (versioned) idents in a taxonomy csv, without loading the lineages"
+    if cache is not None:
+        idents = read_cached(cache, [taxonomy_csv])
+        if idents is not None:
+            return idents
+    with open_table(taxonomy_csv) as fp:
+        idents = [row['ident'] for row in csv.DictReader(fp)]
+    if cache is not None:
+        write_cached(cache, [taxonomy_csv], idents)
+    return idents
@@ -0,0 +1,246 @@
+# shared taxonomy lookup + LCA for the prefetch/linref --> LCA-ANI scripts
+import numpy as np
+from sourmash.lca import lca_utils
+from sourmash.tax import tax_utils
+from sourmash.logging import notify
+
+from taxonomy_cache import read_cached, write_cached
+
+# lca_cache.get() default; None is a cached "no shared rank"
+_MISSING = object()
+
+
+def swap_gcf_gca(ident):
+    # having 202 --> 207 lineage matching issues; try the other assembly prefix
+    if "GCF" in ident:
+        return ident.replace("GCF", "GCA")
+    elif "GCA" in ident:
+        return ident.replace("GCA", "GCF")
+    return ident
+
+
+class TaxonomyIndex:
+    """
+    Identifier --> lineage index with vectorised LCA.
+
+    Each distinct lineage is stored once, as a row of integer taxon ids (one
+    column per rank, top-down). A taxon id stands for the full path down to
+    its rank, so two lineages match down to rank r iff their ids at r are
+    equal, and the LCA is the last column of the leading run of matches.
+    Identifiers are indexed under both their GCF_ and GCA_ forms.
+    """
+    def __init__(self, tax_assign):
+        lineage_rows = {}
+        taxon_ids = {}
+        self.lineages = []
+        self.row_of = {}
+        rows = []
+        for ident in tax_assign:
+            lineage = tuple(tax_assign[ident])
+            row = lineage_rows.get(lineage)
+            if row is None:
+                row = lineage_rows[lineage] = len(self.lineages)
+                self.lineages.append(lineage)
+                path = []
+                parent = -1
+                for lp in lineage:
+                    parent = taxon_ids.setdefault((parent, lp), len(taxon_ids))
+                    path.append(parent)
+                rows.append(path)
+            self.row_of[ident] = row
+
+        # aliases never shadow a real identifier
+        for ident, row in list(self.row_of.items()):
+            self.row_of.setdefault(swap_gcf_gca(ident), row)
+
+        width = max((len(path) for path in rows), default=0)
+        # -1: no taxon at this rank (lineage is shorter)
+        self.taxon_ids = np.full((len(rows), width), -1, dtype=np.int64)
+        for n, path in enumerate(rows):
+            self.taxon_ids[n, :len(path)] = path
+
+        self._init_cache()
+
+    def _init_cache(self, max_cached=1000000):
+        # lineage row pair --> LCA; many genome pairs share a lineage pair.
+        # cleared when full, which is cheaper per lookup than keeping LRU order
+        self.lca_cache = {}
+        self.max_cached = max_cached
+        self.reported_missing = set()
+
+    def __getstate__(self):
+        return {"lineages": self.lineages, "row_of": self.row_of, "taxon_ids": self.taxon_ids}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    @classmethod
+    def load(cls, taxonomy_csvs, cache=None):
+        """
+        Load taxonomy csvs. If `cache` is given, reuse the compiled index stored
+        there when it was built from the same files (path, size, mtime);
+        otherwise build the index and (re)write the cache.
+        """
+        if cache is not None:
+            index = read_cached(cache, taxonomy_csvs)
+            if index is not None:
+                notify(f"loaded taxonomy index from '{cache}'")
+                return index
+        tax_assign = tax_utils.MultiLineageDB.load(taxonomy_csvs, keep_identifier_versions=False)
+        index = cls(tax_assign)
+        if cache is not None:
+            write_cached(cache, taxonomy_csvs, index)
+            notify(f"saved taxonomy index to '{cache}'")
+        return index
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def get_row(self, ident):
+        "lineage row for ident, or -1 if not in taxonomy"
+        return self.row_of.get(ident, -1)
+
+    def report_missing(self, ident):
+        # once per identifier (per process), not once per comparison
+        if ident not in self.reported_missing:
+            self.reported_missing.add(ident)
+            notify(f"{ident} is not in taxonomy files")
+
+    def get_lineage(self, ident):
+        row = self.get_row(ident)
+        if row < 0:
+            return None
+        return self.lineages[row]
+
+    def lca_depths(self, rows1, rows2):
+        "number of leading ranks shared by each pair of lineage rows"
+        ids1 = self.taxon_ids[rows1]
+        ids2 = self.taxon_ids[rows2]
+        shared = (ids1 == ids2) & (ids1 >= 0)
+        return np.cumprod(shared, axis=1).sum(axis=1)
+
+    def shares_rank(self, rows1, rows2, depth):
+        "whether each pair of lineage rows has the same taxon at the depth'th rank (1 = top)"
+        if depth > self.taxon_ids.shape[1]:
+            return np.zeros(len(rows1), dtype=bool)
+        ids1 = self.taxon_ids[rows1, depth - 1]
+        return (ids1 == self.taxon_ids[rows2, depth - 1]) & (ids1 >= 0)
+
+    def lcas_of_rows(self, rows1, rows2):
+        """
+        LCA lineages (None: no shared rank) of pairs of lineage rows. Each
+        distinct pair is looked up once in the cache; the pairs not cached
+        are resolved together with lca_depths.
+        """
+        rows1 = np.asarray(rows1, dtype=np.int64)
+        rows2 = np.asarray(rows2, dtype=np.int64)
+        # the LCA doesn't depend on pair order
+        keys = np.minimum(rows1, rows2) * len(self.lineages) + np.maximum(rows1, rows2)
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        uniq = uniq.tolist()
+        cache = self.lca_cache
+        found = [cache.get(key, _MISSING) for key in uniq]
+        misses = [n for n, lca in enumerate(found) if lca is _MISSING]
+        if misses:
+            if len(cache) + len(misses) > self.max_cached:
+                cache.clear()
+            row1, row2 = np.divmod(np.array([uniq[n] for n in misses], dtype=np.int64), len(self.lineages))
+            for n, row, depth in zip(misses, row1.tolist(), self.lca_depths(row1, row2).tolist()):
+                found[n] = cache[uniq[n]] = self.lineages[row][:depth] if depth else None
+        return [found[n] for n in inverse.tolist()]
+
+    def get_lca(self, id1, id2):
+        "LCA lineage of two identifiers; None if either is missing or they share no rank"
+        return self.get_lcas([(id1, id2)])[0]
+
+    def get_lcas(self, id_pairs):
+        "get_lca over a batch of (id1, id2) pairs"
+        rows = np.array([(self.get_row(id1), self.get_row(id2)) for id1, id2 in id_pairs], dtype=np.int64).reshape(-1, 2)
+        lcas = [None] * len(rows)
+        missing = (rows < 0).any(axis=1)
+        for n in np.flatnonzero(missing):
+            for ident, row in zip(id_pairs[n], rows[n]):
+                if row < 0:
+                    self.report_missing(ident)
+        found = np.flatnonzero(~missing)
+        if len(found):
+            for n, lca in zip(found.tolist(), self.lcas_of_rows(rows[found, 0], rows[found, 1])):
+                lcas[n] = lca
+        return lcas
+
+
+class IdentResolver:
+    """
+    Memoised genome name --> (identifier, lineage row in `tax_index`).
+
+    Prefetch csvs repeat each genome's name in thousands of rows; each
+    distinct name is parsed (get_ident by default) and looked up once per
+    process, misses included (row -1).
+    """
+    def __init__(self, tax_index=None, parse=tax_utils.get_ident):
+        self.tax_index = tax_index
+        self.parse = parse
+        self.resolved = {}
+
+    def __len__(self):
+        return len(self.resolved)
+
+    def resolve(self, name):
+        found = self.resolved.get(name)
+        if found is None:
+            ident = self.parse(name)
+            row = self.tax_index.get_row(ident) if self.tax_index is not None else -1
+            found = self.resolved[name] = (ident, row)
+        return found
+
+    def ident(self, name):
+        return self.resolve(name)[0]
+
+    def ident_pairs(self, names1, names2):
+        resolve = self.resolve
+        return [(resolve(name1)[0], resolve(name2)[0]) for name1, name2 in zip(names1, names2)]
+
+
+class LcaFilter:
+    """
+    Optional ingestion filters: keep comparisons whose LCA rank is in
+    `include_ranks` and at or below `max_lca_rank`, with ANI >= `min_ani`.
+
+    The rank filters are checked in two steps: maybe_keep() is a cheap
+    pre-LCA test (do the lineages share the highest allowed rank?), and
+    keep_lca() checks the resolved LCA exactly.
+    """
+    def __init__(self, include_ranks=None, max_lca_rank=None, min_ani=None):
+        ranks = list(lca_utils.taxlist(include_strain=True))
+        self.ranks = None
+        self.min_depth = 0
+        if include_ranks or max_lca_rank:
+            allowed = ranks[ranks.index(max_lca_rank):] if max_lca_rank else ranks
+            if include_ranks:
+                allowed = [rank for rank in allowed if rank in include_ranks]
+            self.ranks = set(allowed)
+            # every allowed LCA shares at least this many leading ranks
+            self.min_depth = min(ranks.index(rank) for rank in allowed) + 1 if allowed else len(ranks) + 1
+        self.min_ani = min_ani
+
+    def maybe_keep(self, tax_index, id_pairs):
+        """
+        Boolean mask over (id1, id2) pairs; False where the pair can't pass the
+        rank filters. Pairs with a missing identifier are kept, so they are
+        still reported when the LCA is looked up.
+        """
+        if not self.min_depth:
+            return np.ones(len(id_pairs), dtype=bool)
+        rows = np.array([(tax_index.get_row(id1), tax_index.get_row(id2)) for id1, id2 in id_pairs], dtype=np.int64).reshape(-1, 2)
+        missing = (rows < 0).any(axis=1)
+        return missing | tax_index.shares_rank(rows[:, 0], rows[:, 1], self.min_depth)
+
+    def keep_ani(self, ani):
+        ani = np.asarray(ani, dtype=np.float64)
+        if self.min_ani is None:
+            return np.ones(len(ani), dtype=bool)
+        return ani >= self.min_ani
+
+    def keep_lca(self, lca_lin):
+        return lca_lin is not None and (self.ranks is None or lca_lin[-1].rank in self.ranks)